@@ -0,0 +1,159 @@
+import math
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+import torch as t
+
+# z value for a two sided 95% confidence interval
+Z_95 = 1.96
+
+
+@dataclass
+class RunningStat:
+    """Running mean and variance using Welford's algorithm."""
+
+    n: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+
+    def update(self, x: float) -> None:
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self) -> float:
+        if self.n < 2:
+            return math.inf
+        return self.m2 / (self.n - 1)
+
+    def ci_half_width(self, z: float = Z_95) -> float:
+        return z * math.sqrt(self.variance / self.n) if self.n > 0 else math.inf
+
+    def relative_ci_width(self, z: float = Z_95) -> float:
+        """Full confidence interval width relative to the magnitude of the mean."""
+        if self.mean == 0:
+            return math.inf
+        return 2 * self.ci_half_width(z) / abs(self.mean)
+
+
+class _LastBatch:
+    """Iterator wrapper that remembers the last batch it returned."""
+
+    def __init__(self, activations: Iterator):
+        self.activations = activations
+        self.batch = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.batch = next(self.activations)
+        return self.batch
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        return getattr(self.activations, name)
+
+
+@t.no_grad()
+def evaluate_adaptive(
+    dictionary,
+    activations: Iterator,
+    context_length: int,
+    batch_size: int,
+    io: str,
+    device: str,
+    target_relative_ci_widths: dict[str, float],
+    max_batches: int,
+    min_batches: int = 5,
+    z: float = Z_95,
+    evaluate_fn: Optional[Callable[..., dict]] = None,
+) -> dict:
+    """
+    Runs `evaluate` one batch at a time and stops as soon as every metric in
+    `target_relative_ci_widths` has a confidence interval narrower than its target
+    (as a fraction of the metric's mean), or after `max_batches`.
+
+    Returns the same metrics as `evaluate`, averaged over the batches that were run,
+    plus a `confidence_intervals` entry for each tracked metric. Each batch is also
+    encoded once here: mse (mean squared error per element) is computed from it, and
+    frac_alive is the fraction of features active on any of the batches that were run.
+    For io="in_and_out" the batch holds (input, output) pairs and the target is the output.
+
+    evaluate_fn defaults to dictionary_learning's evaluate. Pass a function with the same
+    signature (e.g. transcoder.evaluate_transcoder) to evaluate other dictionaries.
+    Raises ValueError if a metric in `target_relative_ci_widths` is not returned.
+    """
+    if evaluate_fn is None:
+        from dictionary_learning.dictionary_learning.evaluation import evaluate
+
+        evaluate_fn = evaluate
+
+    activations = _LastBatch(activations)
+    dtype = next(dictionary.parameters()).dtype
+    sums = {}
+    stats = {}
+    alive = None
+    n_batches = 0
+
+    for _ in range(max_batches):
+        batch_results = evaluate_fn(
+            dictionary,
+            activations,
+            context_length,
+            batch_size,
+            io=io,
+            device=device,
+            n_batches=1,
+        )
+        n_batches += 1
+
+        x = activations.batch.to(device)
+        if io == "in_and_out":
+            x, target = x[:, 0], x[:, 1]
+        else:
+            target = x
+        f = dictionary.encode(x.to(dtype))
+        residual = target.float() - dictionary.decode(f).float()
+        batch_results["mse"] = residual.pow(2).mean().item()
+
+        batch_alive = (f != 0).any(dim=0)
+        alive = batch_alive if alive is None else alive | batch_alive
+
+        missing = [metric for metric in target_relative_ci_widths if metric not in batch_results]
+        if missing:
+            raise ValueError(
+                f"Early stopping targets {missing} are not returned by the evaluation, "
+                f"which returns {sorted(batch_results)}"
+            )
+
+        for key, value in batch_results.items():
+            if key != "frac_alive":
+                sums[key] = sums.get(key, 0.0) + value
+
+        for metric in target_relative_ci_widths:
+            stats.setdefault(metric, RunningStat()).update(batch_results[metric])
+
+        if n_batches >= min_batches and all(
+            stat.relative_ci_width(z) <= target_relative_ci_widths[metric]
+            for metric, stat in stats.items()
+        ):
+            break
+
+    results = {key: value / n_batches for key, value in sums.items()}
+    results["frac_alive"] = alive.float().mean().item()
+    results["n_batches"] = n_batches
+    results["confidence_intervals"] = {
+        metric: {
+            "mean": stat.mean,
+            "lower": stat.mean - stat.ci_half_width(z),
+            "upper": stat.mean + stat.ci_half_width(z),
+            "relative_width": stat.relative_ci_width(z),
+            "z": z,
+        }
+        for metric, stat in stats.items()
+    }
+
+    return results
@@ -0,0 +1,203 @@
+import os
+import json
+import hashlib
+from typing import Optional, Protocol
+
+MANIFEST_FILENAME = ".upload_manifest.json"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+# Files per commit. Every commit is one request against the hub's commit rate limit.
+FILES_PER_COMMIT = 100
+
+
+class UploadBackend(Protocol):
+    # Used as the key for this destination inside the upload manifest
+    destination: str
+
+    def upload_files(self, files: list[tuple[str, str]], message: str) -> None:
+        """Uploads [(local_path, path_in_repo), ...] as a single commit."""
+        ...
+
+
+class LocalDirBackend:
+    """Copies files into a local directory. Stands in for the hub when testing offline."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.destination = f"local:{os.path.abspath(root)}"
+
+    def upload_files(self, files: list[tuple[str, str]], message: str) -> None:
+        for local_path, path_in_repo in files:
+            target = os.path.join(self.root, path_in_repo)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp_target = f"{target}.partial"
+            with open(local_path, "rb") as src, open(tmp_target, "wb") as dst:
+                while chunk := src.read(HASH_CHUNK_SIZE):
+                    dst.write(chunk)
+            os.replace(tmp_target, target)
+
+
+class HfBackend:
+    """
+    Uploads each batch of files as one hub commit. The files of a commit are uploaded
+    in parallel by huggingface_hub with num_threads threads.
+    """
+
+    def __init__(self, repo_id: str, repo_type: str = "model", num_threads: int = 4):
+        import huggingface_hub
+
+        self.api = huggingface_hub.HfApi()
+        self.repo_id = repo_id
+        self.repo_type = repo_type
+        self.num_threads = num_threads
+        self.destination = f"hf:{repo_type}/{repo_id}"
+
+    def upload_files(self, files: list[tuple[str, str]], message: str) -> None:
+        from huggingface_hub import CommitOperationAdd
+
+        self.api.create_commit(
+            repo_id=self.repo_id,
+            repo_type=self.repo_type,
+            operations=[
+                CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=local_path)
+                for local_path, path_in_repo in files
+            ],
+            commit_message=message,
+            num_threads=self.num_threads,
+        )
+
+
+def hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_manifest(manifest_path: str) -> dict:
+    if not os.path.exists(manifest_path):
+        return {"files": {}, "uploaded": {}}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, manifest_path: str) -> None:
+    # Write to a temp file first so an interrupted run never leaves a corrupt manifest
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def build_manifest(folder: str, previous: Optional[dict] = None) -> dict[str, dict]:
+    """
+    Returns {relative_path: {"sha256", "size", "mtime_ns"}} for every file under `folder`.
+    Hashes are reused from `previous` when size and mtime are unchanged, so
+    re-scanning a directory full of large checkpoints is cheap.
+    """
+    previous = previous or {}
+    files = {}
+
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if filename.startswith(MANIFEST_FILENAME):
+                continue
+            path = os.path.join(root, filename)
+            rel_path = os.path.relpath(path, folder).replace(os.sep, "/")
+            stat = os.stat(path)
+
+            prev = previous.get(rel_path)
+            if (
+                prev is not None
+                and prev["size"] == stat.st_size
+                and prev["mtime_ns"] == stat.st_mtime_ns
+            ):
+                files[rel_path] = prev
+                continue
+
+            files[rel_path] = {
+                "sha256": hash_file(path),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+
+    return files
+
+
+def link_tree(src: str, dst: str) -> None:
+    """
+    Mirrors the directory `src` at `dst` using hard links instead of copies.
+    Falls back to symlinks when `dst` is on a different filesystem.
+    """
+    for root, _, filenames in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+
+        for filename in filenames:
+            src_path = os.path.join(root, filename)
+            dst_path = os.path.join(target_root, filename)
+
+            if os.path.lexists(dst_path):
+                if os.path.samefile(src_path, dst_path):
+                    continue
+                os.remove(dst_path)
+
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                os.symlink(os.path.abspath(src_path), dst_path)
+
+
+def publish_folder(
+    folder: str,
+    backend: UploadBackend,
+    path_in_repo: str = "",
+    files_per_commit: int = FILES_PER_COMMIT,
+    manifest_path: Optional[str] = None,
+) -> list[str]:
+    """
+    Uploads only the files under `folder` that are new or changed since the last
+    successful upload to `backend`, in commits of at most files_per_commit files.
+    Progress is recorded in the manifest after every commit, so an interrupted upload
+    resumes where it stopped.
+
+    Returns the relative paths that were uploaded.
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+
+    manifest = load_manifest(manifest_path)
+    manifest["files"] = build_manifest(folder, manifest["files"])
+    save_manifest(manifest, manifest_path)
+
+    uploaded = manifest["uploaded"].setdefault(backend.destination, {})
+    uploaded_key_prefix = path_in_repo.strip("/")
+
+    def repo_path(rel_path: str) -> str:
+        if uploaded_key_prefix:
+            return f"{uploaded_key_prefix}/{rel_path}"
+        return rel_path
+
+    pending = sorted(
+        rel_path
+        for rel_path, info in manifest["files"].items()
+        if uploaded.get(repo_path(rel_path)) != info["sha256"]
+    )
+
+    print(
+        f"Uploading {len(pending)} of {len(manifest['files'])} files to {backend.destination}"
+    )
+
+    done = []
+    for start in range(0, len(pending), files_per_commit):
+        chunk = pending[start : start + files_per_commit]
+        backend.upload_files(
+            [(os.path.join(folder, rel_path), repo_path(rel_path)) for rel_path in chunk],
+            message=f"Upload {len(chunk)} files ({start + len(chunk)} / {len(pending)})",
+        )
+        for rel_path in chunk:
+            uploaded[repo_path(rel_path)] = manifest["files"][rel_path]["sha256"]
+        save_manifest(manifest, manifest_path)
+        done.extend(chunk)
+
+    return done
@@ -0,0 +1,82 @@
+import argparse
+import itertools
+import time
+
+import torch as t
+
+import demo_config
+from cpu_pool_training import available_cores, train_saes_cpu_pool
+from sae_training import build_trainers
+
+
+def make_configs(args) -> list[dict]:
+    return demo_config.get_trainer_configs(
+        [args.architecture],
+        learning_rates=[1e-3],
+        seeds=list(range(args.num_configs)),
+        activation_dim=args.activation_dim,
+        dict_sizes=[args.dict_size],
+        model_name="EleutherAI/pythia-70m-deduped",
+        device="cpu",
+        layer=3,
+        submodule_name="resid_post_layer_3",
+        steps=args.steps,
+    )
+
+
+def make_data(args):
+    """Cycles through a few random batches, so producing data costs next to nothing."""
+    batches = [t.randn(args.batch_size, args.activation_dim) for _ in range(8)]
+    return itertools.cycle(batches)
+
+
+def time_single_process(args) -> float:
+    """Steps every trainer in turn on one thread pool, like trainSAE."""
+    t.set_num_threads(len(available_cores()))
+    trainers = build_trainers(make_configs(args))
+    data = make_data(args)
+    start = time.perf_counter()
+    for step in range(args.steps):
+        act = next(data)
+        for trainer in trainers:
+            trainer.update(step, act)
+    return time.perf_counter() - start
+
+
+def time_pool(args, num_workers: int) -> float:
+    start = time.perf_counter()
+    train_saes_cpu_pool(
+        make_data(args),
+        make_configs(args),
+        steps=args.steps,
+        num_workers=num_workers,
+    )
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    # Measures how train_saes_cpu_pool scales with the number of workers, against
+    # stepping every trainer in one process. Wall times include spawning the workers.
+    # python benchmark_cpu_pool.py --num_configs 16 --workers 1 2 4 8
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--architecture", type=str, default="top_k")
+    parser.add_argument("--num_configs", type=int, default=16)
+    parser.add_argument("--activation_dim", type=int, default=512)
+    parser.add_argument("--dict_size", type=int, default=4096)
+    parser.add_argument("--batch_size", type=int, default=2048)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    tokens = args.steps * args.batch_size
+    print(f"{len(available_cores())} cores, {args.num_configs} x {args.architecture} configs")
+
+    baseline = time_single_process(args)
+    print(f"single process: {tokens / baseline:,.0f} tokens / second")
+
+    for num_workers in args.workers:
+        seconds = time_pool(args, num_workers)
+        print(
+            f"{num_workers} workers: {tokens / seconds:,.0f} tokens / second, "
+            f"{baseline / seconds:.2f}x single process"
+        )
@@ -0,0 +1,77 @@
+import subprocess
+import sys
+import time
+
+# Modules that must not be imported when running `demo.py --help` or `--dry_run`
+HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "datasets",
+    "huggingface_hub",
+    "dictionary_learning",
+]
+
+DRY_RUN_ARGS = [
+    "--save_dir",
+    "./startup_benchmark",
+    "--model_name",
+    "EleutherAI/pythia-70m-deduped",
+    "--layers",
+    "3",
+    "--architectures",
+    "standard",
+    "batch_top_k",
+    "--dry_run",
+]
+
+
+def time_command(args: list[str], n_runs: int) -> float:
+    """Returns the median wall clock time of running `python demo.py *args`."""
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "demo.py", *args],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def heavy_modules_imported(args: list[str]) -> list[str]:
+    """Runs demo.py's main block in-process and reports which heavy modules were imported."""
+    code = (
+        "import sys, runpy\n"
+        f"sys.argv = ['demo.py', *{args!r}]\n"
+        "try:\n"
+        "    runpy.run_path('demo.py', run_name='__main__')\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print('heavy_imports:' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    imported = result.stdout.strip().splitlines()[-1].removeprefix("heavy_imports:")
+    return [m for m in imported.split(",") if m]
+
+
+if __name__ == "__main__":
+    # Keeps `demo.py --help` and `demo.py --dry_run` fast. Run from the repo root.
+    max_seconds = 1.0
+    n_runs = 5
+
+    failed = False
+    for name, args in [("--help", ["--help"]), ("--dry_run", DRY_RUN_ARGS)]:
+        median = time_command(args, n_runs)
+        imported = heavy_modules_imported(args)
+        print(f"{name}: {median:.3f}s median over {n_runs} runs, heavy imports: {imported}")
+
+        if median > max_seconds or imported:
+            failed = True
+
+    if failed:
+        raise RuntimeError(f"Startup is slower than {max_seconds}s or imports heavy modules")
+
+    print("✅ Startup benchmark passed")
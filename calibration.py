@@ -0,0 +1,310 @@
+"""
+Calibrates the L1-style sparsity penalties so that the full-length runs land on
+demo_config.TARGET_L0s. The hard-coded SPARSITY_PENALTIES were tuned for particular
+models, and on a new model or layer many runs end far from any useful L0.
+
+Activations are read from the buffer once and cached. For every calibrated
+architecture, dict size and target L0, a pilot SAE is trained on the cache with a
+schedule scaled down to `pilot_steps`, and its L0 is measured on held-out batches.
+The penalty is then bisected on log scale, since L0 decreases as the penalty grows.
+Before bisecting, pilots at both ends of each bracket check that the target L0 lies
+inside it, and the bracket is widened if it does not. All pilots of a round train together on the same batches, as in sae_training.train_saes.
+"""
+
+import itertools
+import math
+from contextlib import nullcontext
+from dataclasses import replace
+from typing import Iterator, Optional
+
+import torch as t
+
+import demo_config
+from demo_config import CALIBRATED_ARCHITECTURES, SparsityPenalties
+from sae_training import build_trainers
+
+# The bisection starts from the range of the default penalties, widened by this factor.
+# A bracket that misses its target is shifted by the same factor.
+BRACKET_MARGIN = 4.0
+
+
+def cache_activations(
+    data: Iterator[t.Tensor], n_batches: int, n_eval_batches: int
+) -> tuple[list[t.Tensor], list[t.Tensor], float]:
+    """
+    Returns (train_batches, eval_batches, norm_factor). Batches are kept in the buffer's
+    dtype and normalized when used, like in training, so the penalties found here apply
+    to normalized activations.
+    """
+    batches = [next(data) for _ in range(n_batches + n_eval_batches)]
+
+    mean_squared_norm = sum(act.float().pow(2).sum(dim=-1).mean().item() for act in batches)
+    norm_factor = math.sqrt(mean_squared_norm / len(batches))
+
+    return batches[:n_batches], batches[n_batches:], norm_factor
+
+
+@t.no_grad()
+def measure_l0(ae, eval_batches: list[t.Tensor], norm_factor: float) -> float:
+    total_l0 = 0.0
+    for act in eval_batches:
+        act = act.to(dtype=t.float32) / norm_factor
+        # Transcoder batches are (batch, 2, d), the dictionary encodes the input
+        x = act[:, 0] if act.dim() == 3 else act
+        total_l0 += (ae.encode(x) != 0).float().sum(dim=-1).mean().item()
+    return total_l0 / len(eval_batches)
+
+
+def run_pilots(
+    trainer_configs: list[dict],
+    train_batches: list[t.Tensor],
+    eval_batches: list[t.Tensor],
+    norm_factor: float,
+    pilot_steps: int,
+    autocast_dtype: t.dtype = t.float32,
+) -> list[float]:
+    """Trains every config for pilot_steps on the cached batches and returns their L0s."""
+    trainers = build_trainers(trainer_configs)
+
+    device = trainers[0].device if hasattr(trainers[0], "device") else "cpu"
+    device_type = "cuda" if "cuda" in str(device) else "cpu"
+    autocast_context = (
+        nullcontext()
+        if autocast_dtype == t.float32
+        else t.autocast(device_type=device_type, dtype=autocast_dtype)
+    )
+
+    for step, act in zip(range(pilot_steps), itertools.cycle(train_batches)):
+        act = act.to(dtype=t.float32) / norm_factor
+        for trainer in trainers:
+            with autocast_context:
+                trainer.update(step, act)
+
+    return [measure_l0(trainer.ae, eval_batches, norm_factor) for trainer in trainers]
+
+
+def calibrate_sparsity_penalties(
+    data: Iterator[t.Tensor],
+    architectures: list[str],
+    activation_dim: int,
+    dict_sizes: list[int],
+    model_name: str,
+    device: str,
+    layer: int,
+    submodule_name: str,
+    steps: int,
+    learning_rate: float,
+    seed: int,
+    target_l0s: list[int] = demo_config.TARGET_L0s,
+    pilot_steps: int = demo_config.calibration_pilot_steps,
+    n_rounds: int = demo_config.calibration_rounds,
+    n_cache_batches: int = demo_config.calibration_cache_batches,
+    n_eval_batches: int = demo_config.calibration_eval_batches,
+    max_bracket_expansions: int = demo_config.calibration_max_bracket_expansions,
+    autocast_dtype: t.dtype = t.float32,
+) -> tuple[dict[int, SparsityPenalties], dict]:
+    """
+    Returns (sparsity_penalties, report). sparsity_penalties maps each dict size to one
+    penalty per target L0 for every calibrated architecture, and can be passed to
+    demo_config.get_trainer_configs. Architectures that are not calibrated keep the
+    default penalties. report lists the penalty and pilot L0 of every round, and for
+    every target whether it was inside its bracket ("inside"), inside after widening
+    the bracket ("expanded") or out of reach ("unreachable", the penalty is then the
+    closest end of the bracket).
+
+    `steps` is the length of the full run, used to scale the warmup, sparsity warmup
+    and annealing schedules down to pilot_steps.
+    """
+    architectures = [a for a in architectures if a in CALIBRATED_ARCHITECTURES]
+    defaults = demo_config.SPARSITY_PENALTIES
+    sparsity_penalties = {dict_size: replace(defaults) for dict_size in dict_sizes}
+    report = {"pilot_steps": pilot_steps, "brackets": [], "rounds": []}
+    if not architectures:
+        return sparsity_penalties, report
+
+    train_batches, eval_batches, norm_factor = cache_activations(
+        data, n_cache_batches, n_eval_batches
+    )
+    report["norm_factor"] = norm_factor
+
+    schedule_scale = pilot_steps / steps
+    # Keys are in the order get_trainer_configs produces configs for a single seed and
+    # learning rate: architecture, then dict size, then one penalty per target
+    keys = list(itertools.product(architectures, dict_sizes, target_l0s))
+    log_brackets = {}
+    for architecture, dict_size, target_l0 in keys:
+        penalties = getattr(defaults, architecture)
+        log_brackets[(architecture, dict_size, target_l0)] = [
+            math.log(min(penalties) / BRACKET_MARGIN),
+            math.log(max(penalties) * BRACKET_MARGIN),
+        ]
+
+    def penalties_for(log_penalties: dict[tuple, float]) -> dict[int, SparsityPenalties]:
+        """Per dict size penalties, with the defaults' first penalty for missing keys."""
+        return {
+            dict_size: replace(
+                defaults,
+                **{
+                    architecture: [
+                        math.exp(
+                            log_penalties.get(
+                                (architecture, dict_size, target_l0),
+                                math.log(getattr(defaults, architecture)[0]),
+                            )
+                        )
+                        for target_l0 in target_l0s
+                    ]
+                    for architecture in architectures
+                },
+            )
+            for dict_size in dict_sizes
+        }
+
+    def pilot_l0s(log_penalties: dict[tuple, float]) -> dict[tuple, float]:
+        """Trains one pilot per key of log_penalties and returns the L0 of each."""
+        candidates = penalties_for(log_penalties)
+        pilot_configs = []
+        # One call per architecture keeps the configs in the order of `keys`
+        for architecture in architectures:
+            pilot_configs.extend(
+                demo_config.get_trainer_configs(
+                    [architecture],
+                    [learning_rate],
+                    [seed],
+                    activation_dim,
+                    dict_sizes,
+                    model_name,
+                    device,
+                    layer,
+                    submodule_name,
+                    pilot_steps,
+                    warmup_steps=max(int(demo_config.WARMUP_STEPS * schedule_scale), 1),
+                    sparsity_warmup_steps=max(
+                        int(demo_config.SPARSITY_WARMUP_STEPS * schedule_scale), 1
+                    ),
+                    sparsity_penalties=candidates,
+                )
+            )
+        pilot_keys = [key for key in keys if key in log_penalties]
+        pilot_configs = [
+            config for key, config in zip(keys, pilot_configs) if key in log_penalties
+        ]
+        for config in pilot_configs:
+            config.pop("wandb_name", None)
+            if "anneal_start" in config:
+                config["anneal_start"] = int(config["anneal_start"] * schedule_scale)
+
+        t.manual_seed(seed)
+        l0s = run_pilots(
+            pilot_configs,
+            train_batches,
+            eval_batches,
+            norm_factor,
+            pilot_steps,
+            autocast_dtype,
+        )
+        return dict(zip(pilot_keys, l0s))
+
+    # Bisection only converges if the target lies between the L0s at the two ends of
+    # the bracket, so check the ends first. L0 decreases as the penalty grows.
+    endpoint_l0s = {key: [0.0, 0.0] for key in keys}
+    for side in (0, 1):
+        ends = {key: bracket[side] for key, bracket in log_brackets.items()}
+        for key, l0 in pilot_l0s(ends).items():
+            endpoint_l0s[key][side] = l0
+
+    def missed_side(key: tuple) -> Optional[int]:
+        """0 if even the smallest penalty is too sparse, 1 if the largest is too dense."""
+        target_l0 = key[2]
+        if endpoint_l0s[key][0] < target_l0:
+            return 0
+        if endpoint_l0s[key][1] > target_l0:
+            return 1
+        return None
+
+    bracket_status = {key: "inside" for key in keys}
+    for _ in range(max_bracket_expansions):
+        misses = {key: missed_side(key) for key in keys}
+        misses = {key: side for key, side in misses.items() if side is not None}
+        if not misses:
+            break
+        moved = {}
+        for key, side in misses.items():
+            bracket = log_brackets[key]
+            # The end that missed bounds the target from the other side
+            bracket[1 - side] = bracket[side]
+            endpoint_l0s[key][1 - side] = endpoint_l0s[key][side]
+            bracket[side] += math.log(BRACKET_MARGIN) * (1 if side == 1 else -1)
+            bracket_status[key] = "expanded"
+            moved[key] = bracket[side]
+        for key, l0 in pilot_l0s(moved).items():
+            endpoint_l0s[key][misses[key]] = l0
+
+    for key in keys:
+        side = missed_side(key)
+        if side is not None:
+            # Pin the penalty to the closest end instead of bisecting
+            bracket_status[key] = "unreachable"
+            log_brackets[key] = [log_brackets[key][side]] * 2
+            print(
+                f"WARNING: calibration {key[0]} {key[1]} target {key[2]} is outside the "
+                f"penalty range after {max_bracket_expansions} expansions, using penalty "
+                f"{math.exp(log_brackets[key][0]):.4g} (l0 {endpoint_l0s[key][side]:.1f})"
+            )
+        architecture, dict_size, target_l0 = key
+        report["brackets"].append(
+            {
+                "architecture": architecture,
+                "dict_size": dict_size,
+                "target_l0": target_l0,
+                "status": bracket_status[key],
+                "penalty_range": [math.exp(end) for end in log_brackets[key]],
+                "l0_range": endpoint_l0s[key],
+            }
+        )
+
+    def midpoints() -> dict[tuple, float]:
+        return {key: sum(bracket) / 2 for key, bracket in log_brackets.items()}
+
+    bisected_keys = [key for key in keys if bracket_status[key] != "unreachable"]
+    for round_idx in range(n_rounds):
+        if not bisected_keys:
+            break
+        midpoint = midpoints()
+        log_penalties = {key: midpoint[key] for key in bisected_keys}
+        l0s = pilot_l0s(log_penalties)
+
+        round_report = []
+        for key in bisected_keys:
+            architecture, dict_size, target_l0 = key
+            l0 = l0s[key]
+            bracket = log_brackets[key]
+            log_penalty = log_penalties[key]
+            # Too dense means the penalty is too small
+            if l0 > target_l0:
+                bracket[0] = log_penalty
+            else:
+                bracket[1] = log_penalty
+            round_report.append(
+                {
+                    "architecture": architecture,
+                    "dict_size": dict_size,
+                    "target_l0": target_l0,
+                    "penalty": math.exp(log_penalty),
+                    "l0": l0,
+                }
+            )
+            print(
+                f"calibration round {round_idx} {architecture} {dict_size} "
+                f"target {target_l0}: penalty {math.exp(log_penalty):.4g} -> l0 {l0:.1f}"
+            )
+        report["rounds"].append(round_report)
+
+    sparsity_penalties = penalties_for(midpoints())
+    report["penalties"] = {
+        dict_size: {
+            architecture: getattr(penalties, architecture) for architecture in architectures
+        }
+        for dict_size, penalties in sparsity_penalties.items()
+    }
+    return sparsity_penalties, report
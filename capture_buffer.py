@@ -0,0 +1,231 @@
+import gc
+from typing import Iterator, Optional
+
+import torch as t
+from transformers import AutoTokenizer
+
+from early_exit import collect_activations
+
+
+class CaptureBuffer:
+    """
+    Activation buffer built on early_exit.collect_activations. Supports io="in",
+    io="out" and io="in_and_out". For io="in_and_out" the input and output of the
+    submodule are captured in the same forward pass and stored as paired rows of
+    shape (2, d_submodule), so the pair is always shuffled together. Batches are
+    then (out_batch_size, 2, d_submodule), with [:, 0] the input and [:, 1] the output.
+
+    Padding positions are never stored when remove_padding is set. The first
+    sink_positions real tokens of every context (e.g. BOS, which has a very large norm
+    and acts as an attention sink) can be dropped as well. Kept rows are written
+    directly into the dense buffer, and dropped_fraction reports how much was skipped.
+    """
+
+    def __init__(
+        self,
+        data: Iterator[str],
+        model,
+        submodule: t.nn.Module,
+        d_submodule: int,
+        io: str = "out",
+        n_ctxs: int = 30_000,
+        ctx_len: int = 128,
+        refresh_batch_size: int = 512,
+        out_batch_size: int = 8192,
+        device: str = "cpu",
+        add_special_tokens: bool = True,
+        tokenizer: Optional[AutoTokenizer] = None,
+        remove_padding: bool = True,
+        sink_positions: int = 0,
+    ):
+        if io not in ["in", "out", "in_and_out"]:
+            raise ValueError("io must be either 'in', 'out' or 'in_and_out'")
+
+        self.data = data
+        self.model = model
+        self.submodule = submodule
+        self.d_submodule = d_submodule
+        self.io = io
+        self.n_ctxs = n_ctxs
+        self.ctx_len = ctx_len
+        self.activation_buffer_size = n_ctxs * ctx_len
+        self.refresh_batch_size = refresh_batch_size
+        self.out_batch_size = out_batch_size
+        self.device = device
+        self.add_special_tokens = add_special_tokens
+        self.remove_padding = remove_padding
+        self.sink_positions = sink_positions
+        self.total_positions = 0
+        self.dropped_positions = 0
+
+        if tokenizer is None:
+            tokenizer = AutoTokenizer.from_pretrained(model.name_or_path)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        self.tokenizer = tokenizer
+
+        self.row_shape = (2, d_submodule) if io == "in_and_out" else (d_submodule,)
+        self.activations = t.empty(0, *self.row_shape, device=device, dtype=model.dtype)
+        self.read = t.zeros(0, dtype=t.bool, device=device)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Return a batch of activations
+        """
+        with t.no_grad():
+            # if buffer is less than half full, refresh
+            if (~self.read).sum() < self.activation_buffer_size // 2:
+                self.refresh()
+
+            # return a batch
+            unreads = (~self.read).nonzero().squeeze(-1)
+            idxs = unreads[
+                t.randperm(len(unreads), device=unreads.device)[: self.out_batch_size]
+            ]
+            self.read[idxs] = True
+            return self.activations[idxs]
+
+    def text_batch(self, batch_size: Optional[int] = None) -> list[str]:
+        """
+        Return a list of text
+        """
+        if batch_size is None:
+            batch_size = self.refresh_batch_size
+        try:
+            return [next(self.data) for _ in range(batch_size)]
+        except StopIteration:
+            raise StopIteration("End of data stream reached")
+
+    def tokenized_batch(self, batch_size: Optional[int] = None) -> dict[str, t.Tensor]:
+        """
+        Return a batch of tokenized inputs.
+        """
+        texts = self.text_batch(batch_size=batch_size)
+        return self.tokenizer(
+            texts,
+            return_tensors="pt",
+            max_length=self.ctx_len,
+            padding=True,
+            truncation=True,
+            add_special_tokens=self.add_special_tokens,
+        ).to(self.model.device)
+
+    def refresh(self):
+        gc.collect()
+        if t.cuda.is_available():
+            t.cuda.empty_cache()
+
+        unread_idxs = (~self.read).nonzero().squeeze(-1)
+        current_idx = len(unread_idxs)
+        new_activations = t.empty(
+            self.activation_buffer_size,
+            *self.row_shape,
+            device=self.device,
+            dtype=self.model.dtype,
+        )
+        # Compact the unread rows to the front of the new buffer in a single copy
+        t.index_select(
+            self.activations, 0, unread_idxs, out=new_activations[:current_idx]
+        )
+        self.activations = new_activations
+
+        while current_idx < self.activation_buffer_size:
+            tokens = self.tokenized_batch()
+            with t.no_grad():
+                hidden_states = collect_activations(
+                    self.model, [self.submodule], tokens, io=self.io
+                )[0]
+
+            keep = self.keep_mask(tokens["attention_mask"])
+            self.total_positions += keep.numel()
+            self.dropped_positions += keep.numel() - keep.sum().item()
+
+            remaining_space = self.activation_buffer_size - current_idx
+            keep_idxs = keep.flatten().nonzero().squeeze(-1)[:remaining_space]
+            # With device_map="auto" the submodule can live on a later device than the
+            # inputs and attention mask
+            keep_idxs = keep_idxs.to(hidden_states.device)
+            hidden_states = hidden_states.flatten(0, 1)
+            target = self.activations[current_idx : current_idx + len(keep_idxs)]
+
+            if hidden_states.device == target.device:
+                # Gather the kept rows straight into the buffer, without an intermediate copy
+                t.index_select(hidden_states, 0, keep_idxs, out=target)
+            else:
+                target.copy_(hidden_states[keep_idxs])
+            current_idx += len(keep_idxs)
+
+        self.read = t.zeros(len(self.activations), dtype=t.bool, device=self.device)
+
+    def keep_mask(self, attention_mask: t.Tensor) -> t.Tensor:
+        """Boolean mask of shape (batch, seq) of the positions to store."""
+        if self.remove_padding:
+            keep = attention_mask.bool()
+        else:
+            keep = t.ones_like(attention_mask, dtype=t.bool)
+
+        if self.sink_positions > 0:
+            # Index of each position among the real tokens, so this also works with left padding
+            token_positions = attention_mask.cumsum(dim=1) - 1
+            keep &= token_positions >= self.sink_positions
+
+        return keep
+
+    @property
+    def dropped_fraction(self) -> float:
+        return self.dropped_positions / max(self.total_positions, 1)
+
+    @property
+    def config(self):
+        return {
+            "d_submodule": self.d_submodule,
+            "io": self.io,
+            "n_ctxs": self.n_ctxs,
+            "ctx_len": self.ctx_len,
+            "refresh_batch_size": self.refresh_batch_size,
+            "out_batch_size": self.out_batch_size,
+            "device": self.device,
+            "remove_padding": self.remove_padding,
+            "sink_positions": self.sink_positions,
+        }
+
+
+class CachedActivations:
+    """
+    Wraps an activation buffer and caches every batch it returns. After rewind(), the
+    same batches are replayed in the same order without running the model, so several
+    dictionaries (or the same dictionary at several eval steps) can be evaluated on one
+    collection of held-out activations.
+
+    Batches are only collected the first time they are requested, so an adaptive
+    evaluation that stops early does not pay for the rest of its budget. They are kept on
+    the CPU and moved back to the buffer's device on replay, so the cache doesn't hold
+    accelerator memory during training. Text batches are not cached: loss recovered needs
+    the full model, which a truncated model can't run. Other attributes (model,
+    submodule, ...) are read from the wrapped buffer.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.batches = []
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> t.Tensor:
+        if self.position == len(self.batches):
+            self.batches.append(next(self.buffer).cpu())
+        batch = self.batches[self.position]
+        self.position += 1
+        return batch.to(self.buffer.device)
+
+    def rewind(self) -> None:
+        self.position = 0
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the cache itself
+        return getattr(self.buffer, name)
@@ -0,0 +1,220 @@
+"""
+Trains many small SAEs on CPU with a pool of worker processes. A single process steps
+every trainer one after another on one intra-op thread pool, which leaves most cores
+idle for small dictionaries. Here each worker owns a subset of the trainer configs and
+a fixed number of threads. The main process produces activations on its own reserved
+cores and broadcasts each batch to every worker through shared memory. A batch is
+never pickled or sent through a queue: each worker clones it out of the shared slot
+once, so the slot can be refilled while the worker trains.
+
+benchmark_cpu_pool.py measures how throughput scales with the number of workers.
+
+    python demo.py --save_dir ./cpu --model_name EleutherAI/pythia-70m-deduped --layers 3 --architectures standard top_k --device cpu --cpu_workers 8
+"""
+
+import os
+import json
+import time
+from typing import Iterator, Optional, Union
+
+import torch as t
+import torch.multiprocessing as mp
+
+from sae_training import (
+    build_trainers,
+    get_norm_factor,
+    normalize,
+    save_trainer,
+)
+
+# Number of shared batch slots. With two slots the main process fills the next batch
+# while the workers are still training on the current one.
+NUM_SLOTS = 2
+
+
+def available_cores() -> list[int]:
+    """Cores this process may run on, which respects taskset / cgroup CPU limits."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _wait_for_slot(semaphore, num_workers: int, workers: list) -> None:
+    """Blocks until every worker has released the slot, failing fast if a worker died."""
+    for _ in range(num_workers):
+        while not semaphore.acquire(timeout=1.0):
+            dead = [p for p in workers if not p.is_alive()]
+            if dead:
+                raise RuntimeError(
+                    f"CPU training worker exited with code {dead[0].exitcode}"
+                )
+
+
+def _worker(
+    trainer_indices: list[int],
+    trainer_configs: list[dict],
+    slots: list[t.Tensor],
+    slot_free: list,
+    commands,
+    num_threads: int,
+    cores: Optional[list[int]],
+    norm_factor: Optional[Union[float, list[float]]],
+    save_dir: Optional[str],
+    save_steps: Optional[list[int]],
+    buffer_config: Optional[dict],
+):
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    t.set_num_threads(num_threads)
+
+    trainers = build_trainers(trainer_configs, indices=trainer_indices)
+
+    if save_dir is not None:
+        for i, trainer in zip(trainer_indices, trainers):
+            trainer_dir = os.path.join(save_dir, f"trainer_{i}")
+            os.makedirs(trainer_dir, exist_ok=True)
+            config = {"trainer": trainer.config}
+            if norm_factor is not None:
+                config["trainer"]["norm_factor"] = norm_factor
+            if buffer_config is not None:
+                config["buffer"] = buffer_config
+            with open(os.path.join(trainer_dir, "config.json"), "w") as f:
+                json.dump(config, f, indent=4)
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+
+        step, slot = command
+        # A private copy lets the main process refill the slot while we train
+        act = slots[slot].clone()
+        slot_free[slot].release()
+
+        if save_steps is not None and step in save_steps and save_dir is not None:
+            for i, trainer in zip(trainer_indices, trainers):
+                checkpoint_dir = os.path.join(save_dir, f"trainer_{i}", "checkpoints")
+                save_trainer(trainer, checkpoint_dir, f"ae_{step}.pt", norm_factor)
+
+        for trainer in trainers:
+            trainer.update(step, act)
+
+    if save_dir is not None:
+        for i, trainer in zip(trainer_indices, trainers):
+            if norm_factor is not None:
+                trainer.ae.scale_biases(norm_factor)
+            save_trainer(trainer, os.path.join(save_dir, f"trainer_{i}"))
+
+
+def train_saes_cpu_pool(
+    data: Iterator[t.Tensor],
+    trainer_configs: list[dict],
+    steps: int,
+    num_workers: int,
+    save_dir: Optional[str] = None,
+    save_steps: Optional[list[int]] = None,
+    log_steps: Optional[int] = None,
+    normalize_activations: bool = False,
+    threads_per_worker: Optional[int] = None,
+    producer_threads: Optional[int] = None,
+    pin_cores: bool = True,
+    buffer_config: Optional[dict] = None,
+) -> None:
+    """
+    Same outputs as sae_training.train_saes, but trainer configs are spread round robin
+    over `num_workers` processes, each pinned to `threads_per_worker` cores. The first
+    `producer_threads` available cores are reserved for the main process, which runs
+    the model that produces activations. By default the available cores are split
+    evenly between the producer and the workers. The SAEs are written to save_dir by
+    the workers, nothing is returned.
+    """
+    num_workers = min(num_workers, len(trainer_configs))
+    cores = available_cores()
+    if producer_threads is None:
+        producer_threads = max(len(cores) // (num_workers + 1), 1)
+    if threads_per_worker is None:
+        threads_per_worker = max((len(cores) - producer_threads) // num_workers, 1)
+
+    if buffer_config is None and hasattr(data, "config"):
+        buffer_config = data.config
+
+    norm_factor = get_norm_factor(data, steps=100) if normalize_activations else None
+
+    first_act = next(data).to(dtype=t.float32)
+    slots = [t.empty_like(first_act).share_memory_() for _ in range(NUM_SLOTS)]
+
+    ctx = mp.get_context("spawn")
+    slot_free = [ctx.Semaphore(0) for _ in range(NUM_SLOTS)]
+    command_queues = [ctx.Queue() for _ in range(num_workers)]
+
+    workers = []
+    for worker_idx in range(num_workers):
+        trainer_indices = list(range(worker_idx, len(trainer_configs), num_workers))
+        worker_cores = None
+        if pin_cores:
+            # Cores after the producer's. Wraps around (oversubscribes) if there are
+            # fewer available cores than requested threads.
+            first_core = producer_threads + worker_idx * threads_per_worker
+            worker_cores = [
+                cores[i % len(cores)]
+                for i in range(first_core, first_core + threads_per_worker)
+            ]
+        process = ctx.Process(
+            target=_worker,
+            args=(
+                trainer_indices,
+                [trainer_configs[i] for i in trainer_indices],
+                slots,
+                slot_free,
+                command_queues[worker_idx],
+                threads_per_worker,
+                worker_cores,
+                norm_factor,
+                save_dir,
+                save_steps,
+                buffer_config,
+            ),
+        )
+        process.start()
+        workers.append(process)
+
+    # Pin the producer only once the workers are spawned, so they don't inherit its mask
+    previous_threads = t.get_num_threads()
+    t.set_num_threads(producer_threads)
+    if pin_cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores[:producer_threads])
+
+    start_time = time.time()
+    act = first_act
+
+    try:
+        for step in range(steps):
+            if step > 0:
+                act = next(data).to(dtype=t.float32)
+            if normalize_activations:
+                act = normalize(act, norm_factor)
+
+            slot = step % NUM_SLOTS
+            if step >= NUM_SLOTS:
+                # Every worker must have copied out the batch previously in this slot
+                _wait_for_slot(slot_free[slot], num_workers, workers)
+
+            slots[slot].copy_(act)
+            for queue in command_queues:
+                queue.put((step, slot))
+
+            if log_steps is not None and step % log_steps == 0:
+                tokens_per_second = (step + 1) * len(act) / (time.time() - start_time)
+                print(f"step {step}: {tokens_per_second:,.0f} tokens / second")
+    finally:
+        for queue in command_queues:
+            queue.put(None)
+        for process in workers:
+            process.join()
+        t.set_num_threads(previous_threads)
+        if pin_cores and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+
+    failed = [p.exitcode for p in workers if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"CPU training workers exited with codes {failed}")
@@ -3,31 +3,29 @@ import os
 # I believe this environment variable should be set before importing torch
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 
-import torch as t
-from transformers import AutoModelForCausalLM, AutoTokenizer
 import argparse
-import itertools
+import functools
 import random
 import json
-import torch.multiprocessing as mp
 import time
-import huggingface_hub
-from datasets import config
-from transformers import AutoTokenizer
+from typing import Optional
 
+# Only lightweight imports at module level, so `--help` and `--dry_run` start instantly.
+# torch, transformers, datasets and dictionary_learning are imported where they are used.
 import demo_config
 
-# Kind of janky double importing dictionary_learning.dictionary_learning, but it works
-# This is leftover from when dictionary_learning was a only used as a submodule
-from dictionary_learning.dictionary_learning.utils import (
-    hf_dataset_to_generator,
-    hf_mixed_dataset_to_generator,
-    hf_sequence_packing_dataset_to_generator,
-)
-from dictionary_learning.dictionary_learning.pytorch_buffer import ActivationBuffer
-from dictionary_learning.dictionary_learning.evaluation import evaluate
-from dictionary_learning.dictionary_learning.training import trainSAE
-import dictionary_learning.dictionary_learning.utils as utils
+
+def no_grad(fn):
+    """Same as @t.no_grad(), but defers importing torch until the function is called."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        import torch as t
+
+        with t.no_grad():
+            return fn(*args, **kwargs)
+
+    return wrapper
 
 
 def get_args():
@@ -66,11 +64,208 @@ def get_args():
     parser.add_argument(
         "--mixed_dataset", action="store_true", help="use mixed dataset"
     )
+    parser.add_argument(
+        "--transcoder",
+        action="store_true",
+        help="train transcoders mapping MLP inputs to MLP outputs",
+    )
+    parser.add_argument(
+        "--token_manifest",
+        type=str,
+        help="token census manifest (see token_census.py) used to check the dataset is large enough",
+    )
+    parser.add_argument(
+        "--calibrate_penalties",
+        action="store_true",
+        help="fit the sparsity penalties to TARGET_L0s with short pilot runs before training",
+    )
+    parser.add_argument(
+        "--cpu_workers",
+        type=int,
+        default=1,
+        help="with --device cpu, train the trainer configs in this many worker processes",
+    )
+    parser.add_argument(
+        "--online_eval",
+        action="store_true",
+        help="keep one model resident and evaluate during training instead of in a separate phase",
+    )
+    parser.add_argument(
+        "--posthoc_eval",
+        action="store_true",
+        help="also run the separate evaluation phase when using --online_eval",
+    )
+    parser.add_argument(
+        "--fit_steps_to_manifest",
+        action="store_true",
+        help="train for fewer steps if the token manifest has fewer tokens than num_tokens",
+    )
 
     args = parser.parse_args()
     return args
 
 
+def get_submodule_name(layer: int, transcoder: bool = False) -> str:
+    if transcoder:
+        return f"mlp_layer_{layer}"
+    return f"resid_post_layer_{layer}"
+
+
+def get_dataset_settings(model_name: str, mixed_dataset: bool = False) -> dict:
+    """
+    Keyword arguments of the generator the training data is streamed from. They are also
+    recorded in token census manifests, so a manifest can be checked against the run.
+    """
+    context_length = demo_config.LLM_CONFIG[model_name].context_length
+    if not mixed_dataset:
+        return {
+            "generator": "hf_sequence_packing_dataset_to_generator",
+            "min_chars": context_length * 4,
+        }
+
+    assert "Qwen" in model_name, "Make sure system prompt matches model"
+    return {
+        "generator": "parallel_mixed_dataset_to_generator",
+        "pretrain_dataset": "HuggingFaceFW/fineweb",
+        "chat_dataset": "lmsys/lmsys-chat-1m",
+        "pretrain_frac": 0.9,
+        "sequence_pack_pretrain": True,
+        "system_prompt_to_remove": "<|im_start|>system\nYou are Qwen, created by Alibaba Cloud. You are a helpful assistant.<|im_end|>\n",
+        "min_chars": context_length * 4,
+        "max_tokens_per_sample": context_length,
+    }
+
+
+def get_dataset_generator(tokenizer, settings: dict, rank: int = 0, world_size: int = 1):
+    """With world_size > 1, the generator only reads this rank's part of the dataset."""
+    settings = dict(settings)
+    generator = settings.pop("generator")
+    if generator == "parallel_mixed_dataset_to_generator":
+        from mixed_dataset import parallel_mixed_dataset_to_generator
+
+        # Each source prefetches in its own thread, and the mixture is enforced on tokens
+        return parallel_mixed_dataset_to_generator(
+            tokenizer, **settings, rank=rank, world_size=world_size
+        )
+
+    if world_size > 1:
+        from mixed_dataset import pretrain_source
+
+        # dictionary_learning's generator can only be sharded after reading the whole
+        # stream, so pack the same kind of documents from this rank's part of fineweb
+        return pretrain_source(
+            tokenizer, **settings, rank=rank, world_size=world_size
+        )()
+
+    from dictionary_learning.dictionary_learning.utils import (
+        hf_sequence_packing_dataset_to_generator,
+    )
+
+    return hf_sequence_packing_dataset_to_generator(tokenizer, **settings)
+
+
+def get_dataset_sources(tokenizer, settings: dict) -> tuple[dict, dict]:
+    """The sources of the training stream and their token fractions, for token_census.py."""
+    if settings["generator"] != "parallel_mixed_dataset_to_generator":
+        return {"pretrain": lambda: get_dataset_generator(tokenizer, settings)}, {"pretrain": 1.0}
+
+    from mixed_dataset import mixed_dataset_sources
+
+    # Truncation to the context length is applied by the census itself
+    kwargs = {
+        key: value
+        for key, value in settings.items()
+        if key not in ("generator", "max_tokens_per_sample")
+    }
+    return mixed_dataset_sources(tokenizer, **kwargs)
+
+
+def get_training_steps(
+    model_name: str,
+    num_tokens: int,
+    world_size: int = 1,
+    mixed_dataset: bool = False,
+    token_manifest: Optional[str] = None,
+    fit_steps_to_manifest: bool = False,
+) -> int:
+    """
+    Number of training steps, each consuming one SAE batch per rank. With a token
+    manifest, fails (or shrinks the run) if the datasets run out of tokens before then.
+    """
+    llm_config = demo_config.LLM_CONFIG[model_name]
+    steps = int(num_tokens / (llm_config.sae_batch_size * world_size))
+    if token_manifest is not None:
+        from token_census import steps_from_manifest
+
+        steps = steps_from_manifest(
+            token_manifest,
+            num_tokens,
+            llm_config.sae_batch_size * world_size,
+            llm_config.context_length,
+            model_name,
+            get_dataset_settings(model_name, mixed_dataset),
+            allow_fewer_steps=fit_steps_to_manifest,
+        )
+    return steps
+
+
+def plan_sae_training(
+    model_name: str,
+    layer: int,
+    device: str,
+    architectures: list,
+    num_tokens: int,
+    random_seeds: list[int],
+    dictionary_widths: list[int],
+    learning_rates: list[float],
+    transcoder: bool = False,
+    token_manifest: Optional[str] = None,
+    fit_steps_to_manifest: bool = False,
+    calibrate_penalties: bool = False,
+    mixed_dataset: bool = False,
+) -> list[dict]:
+    """Builds the trainer configs for a sweep without loading the model or any trainer code."""
+    steps = get_training_steps(
+        model_name,
+        num_tokens,
+        mixed_dataset=mixed_dataset,
+        token_manifest=token_manifest,
+        fit_steps_to_manifest=fit_steps_to_manifest,
+    )
+    submodule_name = get_submodule_name(layer, transcoder)
+
+    sparsity_penalties = None
+    if calibrate_penalties:
+        # Calibration yields one penalty per target L0, so the trainer count and numbering
+        # differ from a run with the default penalties
+        sparsity_penalties = demo_config.placeholder_calibrated_penalties(
+            architectures, dictionary_widths
+        )
+
+    trainer_configs = demo_config.get_trainer_configs(
+        architectures,
+        learning_rates,
+        random_seeds,
+        demo_config.get_activation_dim(model_name),
+        dictionary_widths,
+        model_name,
+        device,
+        layer,
+        submodule_name,
+        steps,
+        resolve_classes=False,
+        sparsity_penalties=sparsity_penalties,
+    )
+
+    print(f"Dry run: {submodule_name}, {num_tokens} tokens, {steps} steps")
+    if calibrate_penalties:
+        print(f"  sparsity penalties will be calibrated to L0s {demo_config.TARGET_L0s}")
+    for i, config in enumerate(trainer_configs):
+        print(f"  trainer_{i}: {config['trainer']} dict_size={config['dict_size']}")
+
+    return trainer_configs
+
+
 def run_sae_training(
     model_name: str,
     layer: int,
@@ -86,23 +281,89 @@ def run_sae_training(
     save_checkpoints: bool = False,
     buffer_tokens: int = 250_000,
     mixed_dataset: bool = False,
+    transcoder: bool = False,
+    token_manifest: Optional[str] = None,
+    fit_steps_to_manifest: bool = False,
+    model=None,
+    eval_input_strings: Optional[list[str]] = None,
+    cpu_workers: int = 1,
+    calibrate_penalties: bool = False,
 ):
+    """
+    If `model` is given it is used as is (it must be truncated to at least `layer`), so
+    one model can stay resident across layers and evaluation. If `eval_input_strings`
+    is given, every SAE is evaluated on them at demo_config.online_eval_fractions of
+    training and at the end, and eval_results.json is written without a separate phase.
+    """
+    if dry_run:
+        plan_sae_training(
+            model_name,
+            layer,
+            device,
+            architectures,
+            num_tokens,
+            random_seeds,
+            dictionary_widths,
+            learning_rates,
+            transcoder,
+            token_manifest,
+            fit_steps_to_manifest,
+            calibrate_penalties,
+            mixed_dataset,
+        )
+        return
+
+    import copy
+    import torch as t
+    from transformers import AutoTokenizer
+
+    # Kind of janky double importing dictionary_learning.dictionary_learning, but it works
+    # This is leftover from when dictionary_learning was a only used as a submodule
+    from dictionary_learning.dictionary_learning.training import trainSAE
+    from dictionary_learning.dictionary_learning.pytorch_buffer import ActivationBuffer
+    from capture_buffer import CaptureBuffer
+    from early_exit import get_layer, get_mlp, load_truncated_model
+    from mixed_dataset import TokenRatioMixer
+    from cpu_pool_training import train_saes_cpu_pool
+    from calibration import calibrate_sparsity_penalties
+    from sae_training import (
+        get_local_device,
+        init_distributed,
+        train_saes,
+    )
+
+    print(f"NOTE: Training on {num_tokens} tokens")
+
     random.seed(demo_config.random_seeds[0])
     t.manual_seed(demo_config.random_seeds[0])
 
+    # When launched with torchrun, each rank trains on its own shard of the data
+    rank, world_size = init_distributed()
+    device = get_local_device(device)
+
     # model and data parameters
     context_length = demo_config.LLM_CONFIG[model_name].context_length
 
     llm_batch_size = demo_config.LLM_CONFIG[model_name].llm_batch_size
     sae_batch_size = demo_config.LLM_CONFIG[model_name].sae_batch_size
-    dtype = demo_config.LLM_CONFIG[model_name].dtype
+    dtype = demo_config.LLM_CONFIG[model_name].torch_dtype
 
     num_buffer_inputs = buffer_tokens // context_length
     print(f"buffer_size: {num_buffer_inputs}, buffer_size_in_tokens: {buffer_tokens}")
 
     log_steps = 100  # Log the training on wandb or print to console every log_steps
 
-    steps = int(num_tokens / sae_batch_size)  # Total number of batches to train
+    # Total number of batches to train. With a token manifest this fails fast (or shrinks
+    # the run) before loading the model, instead of running out of data partway through
+    steps = get_training_steps(
+        model_name,
+        num_tokens,
+        world_size,
+        mixed_dataset,
+        token_manifest,
+        fit_steps_to_manifest,
+    )
+    dataset_settings = get_dataset_settings(model_name, mixed_dataset)
 
     if save_checkpoints:
         # Creates checkpoints at 0.0%, 0.1%, 0.316%, 1%, 3.16%, 10%, 31.6%, 100% of training
@@ -117,47 +378,90 @@ def run_sae_training(
     else:
         save_steps = None
 
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name, device_map="auto", torch_dtype=dtype
-    )
-
-    model = utils.truncate_model(model, layer)
+    if model is None and world_size > 1:
+        model = load_truncated_model(model_name, layer, dtype, device_map={"": device})
+    elif model is None:
+        model = load_truncated_model(model_name, layer, dtype)
 
     tokenizer = AutoTokenizer.from_pretrained(model_name)
-    submodule = utils.get_submodule(model, layer)
-    submodule_name = f"resid_post_layer_{layer}"
-    io = "out"
+    submodule_name = get_submodule_name(layer, transcoder)
+    if transcoder:
+        # Inputs and outputs of the MLP are captured together in a single forward pass
+        submodule = get_mlp(model, layer)
+        io = "in_and_out"
+    else:
+        submodule = get_layer(model, layer)
+        io = "out"
     activation_dim = model.config.hidden_size
 
-    if mixed_dataset:
-        qwen_system_prompt_to_remove = "<|im_start|>system\nYou are Qwen, created by Alibaba Cloud. You are a helpful assistant.<|im_end|>\n"
-
-        assert "Qwen" in model_name, "Make sure system prompt matches model"
+    # Under torchrun every rank reads a disjoint part of the datasets
+    generator = get_dataset_generator(tokenizer, dataset_settings, rank, world_size)
+    mixer = generator if isinstance(generator, TokenRatioMixer) else None
 
-        generator = hf_mixed_dataset_to_generator(
-            tokenizer,
-            system_prompt_to_remove=qwen_system_prompt_to_remove,
-            min_chars=context_length * 4,
+    if transcoder or demo_config.sink_positions > 0:
+        # Paired MLP input / output capture and attention sink removal need CaptureBuffer.
+        # Padding and sink positions are dropped before they reach the buffer.
+        activation_buffer = CaptureBuffer(
+            generator,
+            model,
+            submodule,
+            n_ctxs=num_buffer_inputs,
+            ctx_len=context_length,
+            refresh_batch_size=llm_batch_size,
+            out_batch_size=sae_batch_size,
+            io=io,
+            d_submodule=activation_dim,
+            device=device,
+            add_special_tokens=False,
+            tokenizer=tokenizer,
+            remove_padding=True,
+            sink_positions=demo_config.sink_positions,
         )
     else:
-        generator = hf_sequence_packing_dataset_to_generator(
-            tokenizer,
-            min_chars=context_length * 4,
+        activation_buffer = ActivationBuffer(
+            generator,
+            model,
+            submodule,
+            n_ctxs=num_buffer_inputs,
+            ctx_len=context_length,
+            refresh_batch_size=llm_batch_size,
+            out_batch_size=sae_batch_size,
+            io=io,
+            d_submodule=activation_dim,
+            device=device,
+            add_special_tokens=False,
         )
 
-    activation_buffer = ActivationBuffer(
-        generator,
-        model,
-        submodule,
-        n_ctxs=num_buffer_inputs,
-        ctx_len=context_length,
-        refresh_batch_size=llm_batch_size,
-        out_batch_size=sae_batch_size,
-        io=io,
-        d_submodule=activation_dim,
-        device=device,
-        add_special_tokens=False,
-    )
+    save_dir = f"{save_dir}/{submodule_name}"
+
+    sparsity_penalties = None
+    if calibrate_penalties:
+        # Pilot runs on cached activations, so every full-length run lands near a target L0
+        sparsity_penalties, calibration_report = calibrate_sparsity_penalties(
+            activation_buffer,
+            architectures,
+            activation_dim,
+            dictionary_widths,
+            model_name,
+            device,
+            layer,
+            submodule_name,
+            steps,
+            learning_rate=learning_rates[0],
+            seed=random_seeds[0],
+            autocast_dtype=t.bfloat16,
+        )
+        if world_size > 1:
+            # Every rank calibrated on its own shard, use rank 0's penalties everywhere
+            import torch.distributed as dist
+
+            shared = [sparsity_penalties, calibration_report]
+            dist.broadcast_object_list(shared, src=0)
+            sparsity_penalties, calibration_report = shared
+        if rank == 0:
+            os.makedirs(save_dir, exist_ok=True)
+            with open(f"{save_dir}/penalty_calibration.json", "w") as f:
+                json.dump(calibration_report, f, indent=4)
 
     trainer_configs = demo_config.get_trainer_configs(
         architectures,
@@ -170,13 +474,92 @@ def run_sae_training(
         layer,
         submodule_name,
         steps,
+        sparsity_penalties=sparsity_penalties,
     )
 
     print(f"len trainer configs: {len(trainer_configs)}")
     assert len(trainer_configs) > 0
-    save_dir = f"{save_dir}/{submodule_name}"
 
-    if not dry_run:
+    online_eval = eval_input_strings is not None
+    if online_eval:
+        # Collected during the first evaluation, then shared by every trainer and step
+        eval_buffer = get_eval_buffer(
+            model,
+            submodule,
+            eval_input_strings,
+            model_name,
+            device,
+            io=io,
+            sink_positions=demo_config.sink_positions,
+        )
+
+    def evaluate_trainers(step: int, dictionaries: list):
+        for i, dictionary in enumerate(dictionaries):
+            # Evaluate a copy in the model's dtype, training continues on the original
+            dictionary = copy.deepcopy(dictionary).to(dtype=model.dtype)
+            eval_results = evaluate_dictionary(
+                dictionary,
+                eval_buffer,
+                model_name,
+                device,
+                io=io,
+                relative_ci_widths=demo_config.eval_relative_ci_widths,
+            )
+            eval_results["step"] = step
+            del dictionary
+
+            trainer_dir = f"{save_dir}/trainer_{i}"
+            history_filename = f"{trainer_dir}/online_eval_results.json"
+            history = []
+            if os.path.exists(history_filename):
+                with open(history_filename, "r") as f:
+                    history = json.load(f)
+            history.append(eval_results)
+            with open(history_filename, "w") as f:
+                json.dump(history, f)
+
+            if step == steps:
+                with open(f"{trainer_dir}/eval_results.json", "w") as f:
+                    json.dump(eval_results, f)
+
+            print(
+                f"trainer_{i} step {step}: l0 {eval_results['l0']:.1f}, "
+                f"frac_variance_explained {eval_results['frac_variance_explained']:.4f}"
+            )
+
+    if cpu_workers > 1:
+        assert device == "cpu", "--cpu_workers requires --device cpu"
+        assert not online_eval, "--online_eval is not supported with --cpu_workers"
+        assert world_size == 1, "--cpu_workers is not supported with torchrun"
+        # Each worker process trains a subset of the configs on its own cores
+        train_saes_cpu_pool(
+            data=activation_buffer,
+            trainer_configs=trainer_configs,
+            steps=steps,
+            num_workers=cpu_workers,
+            save_steps=save_steps,
+            save_dir=save_dir,
+            log_steps=log_steps,
+            normalize_activations=True,
+        )
+    elif world_size > 1 or online_eval or transcoder:
+        # dictionary_learning's trainSAE normalizes with a single scalar, transcoders
+        # need separate input and output norm factors
+        eval_steps = [int(steps * frac) for frac in demo_config.online_eval_fractions]
+        train_saes(
+            data=activation_buffer,
+            trainer_configs=trainer_configs,
+            steps=steps,
+            save_steps=save_steps,
+            save_dir=save_dir,
+            log_steps=log_steps,
+            normalize_activations=True,
+            autocast_dtype=t.bfloat16,
+            eval_steps=eval_steps if online_eval else None,
+            eval_fn=evaluate_trainers if online_eval else None,
+            backup_steps=1000,
+        )
+    else:
         # actually run the sweep
         trainSAE(
             data=activation_buffer,
@@ -193,8 +576,166 @@ def run_sae_training(
             backup_steps=1000,
         )
 
+    if isinstance(activation_buffer, CaptureBuffer):
+        record_dropped_positions(activation_buffer, save_dir, len(trainer_configs), rank, world_size)
+
+    if mixer is not None:
+        print(mixer.report())
+        mixer.close()
+
+
+def record_dropped_positions(
+    activation_buffer, save_dir: str, num_trainers: int, rank: int, world_size: int
+):
+    """Adds the fraction of positions the buffer dropped to every trainer's config.json."""
+    import torch as t
+
+    positions = t.tensor(
+        [activation_buffer.total_positions, activation_buffer.dropped_positions],
+        device=activation_buffer.device,
+    )
+    if world_size > 1:
+        import torch.distributed as dist
+
+        dist.all_reduce(positions)
+    total_positions, dropped_positions = positions.tolist()
+    dropped_fraction = dropped_positions / max(total_positions, 1)
+    print(f"Dropped {dropped_fraction:.1%} of positions (padding / sinks)")
+
+    if rank != 0:
+        return
+    for i in range(num_trainers):
+        config_filename = f"{save_dir}/trainer_{i}/config.json"
+        with open(config_filename, "r") as f:
+            config = json.load(f)
+        config.setdefault("buffer", {}).update(
+            total_positions=total_positions,
+            dropped_positions=dropped_positions,
+            dropped_fraction=dropped_fraction,
+        )
+        with open(config_filename, "w") as f:
+            json.dump(config, f, indent=4)
+
+
+def get_eval_input_strings(n_inputs: int) -> list[str]:
+    from dictionary_learning.dictionary_learning.utils import hf_dataset_to_generator
+
+    generator = hf_dataset_to_generator("monology/pile-uncopyrighted")
+
+    input_strings = []
+    for i, example in enumerate(generator):
+        input_strings.append(example)
+        if i > n_inputs * 5:
+            break
+
+    return input_strings
+
+
+def get_loss_recovered_batch_size(model_name: str) -> int:
+    return max(demo_config.LLM_CONFIG[model_name].llm_batch_size // 5, 1)
+
+
+def get_eval_buffer(
+    model,
+    submodule,
+    input_strings: list[str],
+    model_name: str,
+    device: str,
+    io: str = "out",
+    sink_positions: int = 0,
+):
+    """
+    Held-out activations for evaluate_dictionary. They are collected once and replayed
+    for every dictionary evaluated on the same submodule, so the model only runs for the
+    first evaluation.
+    """
+    from capture_buffer import CachedActivations, CaptureBuffer
+
+    context_length = demo_config.LLM_CONFIG[model_name].context_length
+    loss_recovered_batch_size = get_loss_recovered_batch_size(model_name)
+
+    # The buffer holds a single eval batch of contexts and is refilled one batch at a
+    # time, so when the adaptive evaluation stops early no activations are collected
+    # for the unused part of the n_inputs budget
+    activation_buffer = CaptureBuffer(
+        iter(input_strings),
+        model,
+        submodule,
+        n_ctxs=loss_recovered_batch_size,
+        ctx_len=context_length,
+        refresh_batch_size=loss_recovered_batch_size,
+        out_batch_size=loss_recovered_batch_size * context_length,
+        io=io,
+        d_submodule=model.config.hidden_size,
+        device=device,
+        remove_padding=True,
+        sink_positions=sink_positions,
+    )
+    return CachedActivations(activation_buffer)
+
+
+@no_grad
+def evaluate_dictionary(
+    dictionary,
+    activation_buffer,
+    model_name: str,
+    device: str,
+    io: str = "out",
+    relative_ci_widths: Optional[dict[str, float]] = None,
+    n_inputs: int = demo_config.eval_num_inputs,
+) -> dict:
+    """Evaluates on `activation_buffer` (see get_eval_buffer) from its first batch."""
+    from dictionary_learning.dictionary_learning.evaluation import evaluate
+    from adaptive_eval import evaluate_adaptive
+    from transcoder import evaluate_transcoder
+
+    if io == "in_and_out":
+        # Paired rows: encode the MLP input, compare against the MLP output
+        evaluate = evaluate_transcoder
 
-@t.no_grad()
+    context_length = demo_config.LLM_CONFIG[model_name].context_length
+    loss_recovered_batch_size = get_loss_recovered_batch_size(model_name)
+
+    n_batches = n_inputs // loss_recovered_batch_size
+
+    activation_buffer.rewind()
+
+    if relative_ci_widths is None:
+        eval_results = evaluate(
+            dictionary,
+            activation_buffer,
+            context_length,
+            loss_recovered_batch_size,
+            io=io,
+            device=device,
+            n_batches=n_batches,
+        )
+    else:
+        # n_batches is the maximum budget, most SAEs stop well before it
+        eval_results = evaluate_adaptive(
+            dictionary,
+            activation_buffer,
+            context_length,
+            loss_recovered_batch_size,
+            io=io,
+            device=device,
+            target_relative_ci_widths=relative_ci_widths,
+            max_batches=n_batches,
+            min_batches=demo_config.eval_min_batches,
+            evaluate_fn=evaluate,
+        )
+
+    hyperparameters = {
+        "n_inputs": n_inputs,
+        "context_length": context_length,
+        "relative_ci_widths": relative_ci_widths,
+    }
+    eval_results["hyperparameters"] = hyperparameters
+
+    return eval_results
+
+
+@no_grad
 def eval_saes(
     model_name: str,
     ae_paths: list[str],
@@ -202,7 +743,17 @@ def eval_saes(
     device: str,
     overwrite_prev_results: bool = False,
     transcoder: bool = False,
+    relative_ci_widths: Optional[dict[str, float]] = None,
+    model=None,
+    input_strings: Optional[list[str]] = None,
 ) -> dict:
+    """Pass `model` and `input_strings` to reuse a resident model and eval data."""
+    import torch as t
+
+    import dictionary_learning.dictionary_learning.utils as utils
+    from early_exit import get_layer, get_mlp, load_truncated_model
+    from transcoder import load_transcoder
+
     random.seed(demo_config.random_seeds[0])
     t.manual_seed(demo_config.random_seeds[0])
 
@@ -211,42 +762,29 @@ def eval_saes(
     else:
         io = "out"
 
-    context_length = demo_config.LLM_CONFIG[model_name].context_length
-    llm_batch_size = demo_config.LLM_CONFIG[model_name].llm_batch_size
-    loss_recovered_batch_size = max(llm_batch_size // 5, 1)
-    sae_batch_size = loss_recovered_batch_size * context_length
-    dtype = demo_config.LLM_CONFIG[model_name].dtype
+    dtype = demo_config.LLM_CONFIG[model_name].torch_dtype
 
-    max_layer = 0
+    if model is None:
+        max_layer = 0
 
-    for ae_path in ae_paths:
-        config_path = f"{ae_path}/config.json"
+        for ae_path in ae_paths:
+            config_path = f"{ae_path}/config.json"
 
-        with open(config_path, "r") as f:
-            config = json.load(f)
+            with open(config_path, "r") as f:
+                config = json.load(f)
 
-        layer = config["trainer"]["layer"]
-        max_layer = max(max_layer, layer)
-
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name, device_map="auto", torch_dtype=dtype
-    )
-
-    model = utils.truncate_model(model, max_layer)
+            layer = config["trainer"]["layer"]
+            max_layer = max(max_layer, layer)
 
-    buffer_size = n_inputs
-    io = "out"
-    n_batches = n_inputs // loss_recovered_batch_size
-
-    generator = hf_dataset_to_generator("monology/pile-uncopyrighted")
+        model = load_truncated_model(model_name, max_layer, dtype)
 
-    input_strings = []
-    for i, example in enumerate(generator):
-        input_strings.append(example)
-        if i > n_inputs * 5:
-            break
+    if input_strings is None:
+        input_strings = get_eval_input_strings(n_inputs)
 
     eval_results = {}
+    # One collection of held-out activations per (layer, sink_positions), replayed for
+    # every dictionary trained on it
+    eval_buffers = {}
 
     for ae_path in ae_paths:
         output_filename = f"{ae_path}/eval_results.json"
@@ -255,43 +793,42 @@ def eval_saes(
                 print(f"Skipping {ae_path} as eval results already exist")
                 continue
 
-        dictionary, config = utils.load_dictionary(ae_path, device)
+        if transcoder:
+            dictionary, config = load_transcoder(ae_path, device)
+        else:
+            dictionary, config = utils.load_dictionary(ae_path, device)
         dictionary = dictionary.to(dtype=model.dtype)
 
         layer = config["trainer"]["layer"]
-        submodule = utils.get_submodule(model, layer)
 
-        activation_dim = config["trainer"]["activation_dim"]
-
-        activation_buffer = ActivationBuffer(
-            iter(input_strings),
-            model,
-            submodule,
-            n_ctxs=buffer_size,
-            ctx_len=context_length,
-            refresh_batch_size=llm_batch_size,
-            out_batch_size=sae_batch_size,
-            io=io,
-            d_submodule=activation_dim,
-            device=device,
-        )
-
-        eval_results = evaluate(
+        # Evaluate on the same positions the SAE was trained on
+        sink_positions = config.get("buffer", {}).get("sink_positions", 0)
+
+        if (layer, sink_positions) not in eval_buffers:
+            if transcoder:
+                submodule = get_mlp(model, layer)
+            else:
+                submodule = get_layer(model, layer)
+            eval_buffers[layer, sink_positions] = get_eval_buffer(
+                model,
+                submodule,
+                input_strings,
+                model_name,
+                device,
+                io=io,
+                sink_positions=sink_positions,
+            )
+
+        eval_results = evaluate_dictionary(
             dictionary,
-            activation_buffer,
-            context_length,
-            loss_recovered_batch_size,
+            eval_buffers[layer, sink_positions],
+            model_name,
+            device,
             io=io,
-            device=device,
-            n_batches=n_batches,
+            relative_ci_widths=relative_ci_widths,
+            n_inputs=n_inputs,
         )
 
-        hyperparameters = {
-            "n_inputs": n_inputs,
-            "context_length": context_length,
-        }
-        eval_results["hyperparameters"] = hyperparameters
-
         print(eval_results)
 
         with open(output_filename, "w") as f:
@@ -302,46 +839,107 @@ def eval_saes(
 
 
 def push_to_huggingface(save_dir: str, repo_id: str):
-    api = huggingface_hub.HfApi()
+    from artifact_upload import HfBackend, publish_folder
 
-    api.upload_folder(
-        folder_path=save_dir,
-        repo_id=repo_id,
-        repo_type="model",
-        path_in_repo=save_dir,
-    )
+    # Only new or changed files are uploaded; interrupted uploads resume from the manifest
+    publish_folder(save_dir, HfBackend(repo_id), path_in_repo=save_dir)
 
 
 if __name__ == "__main__":
     """python demo.py --save_dir ./run2 --model_name EleutherAI/pythia-70m-deduped --layers 3 --architectures standard jump_relu batch_top_k top_k gated --use_wandb
     python demo.py --save_dir ./run3 --model_name google/gemma-2-2b --layers 12 --architectures standard top_k --use_wandb
-    python demo.py --save_dir ./jumprelu --model_name EleutherAI/pythia-70m-deduped --layers 3 --architectures jump_relu --use_wandb"""
+    python demo.py --save_dir ./jumprelu --model_name EleutherAI/pythia-70m-deduped --layers 3 --architectures jump_relu --use_wandb
+    python demo.py --save_dir ./transcoders --model_name EleutherAI/pythia-70m-deduped --layers 3 --architectures transcoder_top_k --transcoder
+    torchrun --nproc_per_node 4 demo.py --save_dir ./ddp --model_name Qwen/Qwen2.5-Coder-32B-Instruct --layers 32 --architectures batch_top_k --mixed_dataset
+    python demo.py --save_dir ./online --model_name Qwen/Qwen2.5-Coder-32B-Instruct --layers 16 32 --architectures batch_top_k --mixed_dataset --online_eval
+    python demo.py --save_dir ./calibrated --model_name google/gemma-2-2b --layers 12 --architectures standard gated p_anneal --calibrate_penalties"""
     args = get_args()
 
     hf_repo_id = args.hf_repo_id
 
-    if hf_repo_id:
+    if hf_repo_id and not args.dry_run:
+        import huggingface_hub
+
         assert huggingface_hub.repo_exists(repo_id=hf_repo_id, repo_type="model")
 
     # This prevents random CUDA out of memory errors
     os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 
-    # For wandb to work with multiprocessing
-    mp.set_start_method("spawn", force=True)
+    if not args.dry_run:
+        import torch.multiprocessing as mp
+        from datasets import config
+
+        # For wandb to work with multiprocessing
+        mp.set_start_method("spawn", force=True)
 
-    # Rarely I have internet issues on cloud GPUs and then the streaming read fails
-    # Hopefully the outage is shorter than 100 * 20 seconds
-    config.STREAMING_READ_MAX_RETRIES = 100
-    config.STREAMING_READ_RETRY_INTERVAL = 20
+        # Rarely I have internet issues on cloud GPUs and then the streaming read fails
+        # Hopefully the outage is shorter than 100 * 20 seconds
+        config.STREAMING_READ_MAX_RETRIES = 100
+        config.STREAMING_READ_RETRY_INTERVAL = 20
 
     start_time = time.time()
 
+    # Transcoder trainers read paired (input, output) rows, SAE trainers read single rows
+    transcoder_architectures = set(args.architectures) & set(
+        demo_config.TRANSCODER_ARCHITECTURES
+    )
+    if args.transcoder and transcoder_architectures != set(args.architectures):
+        raise ValueError(
+            f"--transcoder requires transcoder architectures: {demo_config.TRANSCODER_ARCHITECTURES}"
+        )
+    if not args.transcoder and transcoder_architectures:
+        raise ValueError(f"{sorted(transcoder_architectures)} require --transcoder")
+
+    # PAnnealTrainer adapts its sparsity coefficient from the local batch, which the
+    # data-parallel trainer doesn't sync, so the ranks' coefficients would drift apart
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1 and "p_anneal" in args.architectures:
+        raise ValueError("p_anneal is not supported with torchrun")
+
+    # Only dictionary_learning's trainSAE logs to wandb, the other training paths don't
+    if args.use_wandb and (
+        int(os.environ.get("WORLD_SIZE", 1)) > 1
+        or args.online_eval
+        or args.transcoder
+        or args.cpu_workers > 1
+    ):
+        raise ValueError(
+            "--use_wandb is not supported with torchrun, --online_eval, --transcoder or --cpu_workers"
+        )
+
     save_dir = (
         f"{args.save_dir}_{args.model_name}_{'_'.join(args.architectures)}".replace(
             "/", "_"
         )
     )
 
+    model = None
+    eval_input_strings = None
+    if args.online_eval and not args.dry_run:
+        from early_exit import load_truncated_model
+        from sae_training import get_local_device, init_distributed
+
+        # One model, truncated after the deepest layer, is shared by every layer's
+        # training run and by evaluation
+        _, world_size = init_distributed()
+        # The manifest check is the same for every layer, so run it before loading the
+        # model rather than in the first run_sae_training
+        get_training_steps(
+            args.model_name,
+            demo_config.num_tokens,
+            world_size,
+            args.mixed_dataset,
+            args.token_manifest,
+            args.fit_steps_to_manifest,
+        )
+        device_map = {"": get_local_device(args.device)} if world_size > 1 else "auto"
+        model = load_truncated_model(
+            args.model_name,
+            max(args.layers),
+            demo_config.LLM_CONFIG[args.model_name].torch_dtype,
+            device_map=device_map,
+        )
+        eval_input_strings = get_eval_input_strings(demo_config.eval_num_inputs)
+
     for layer in args.layers:
         run_sae_training(
             model_name=args.model_name,
@@ -357,17 +955,39 @@ if __name__ == "__main__":
             use_wandb=args.use_wandb,
             save_checkpoints=args.save_checkpoints,
             mixed_dataset=args.mixed_dataset,
+            transcoder=args.transcoder,
+            token_manifest=args.token_manifest,
+            fit_steps_to_manifest=args.fit_steps_to_manifest,
+            model=model,
+            eval_input_strings=eval_input_strings,
+            cpu_workers=args.cpu_workers,
+            calibrate_penalties=args.calibrate_penalties,
         )
 
+    if args.dry_run:
+        exit(0)
+
+    from sae_training import get_rank
+    import dictionary_learning.dictionary_learning.utils as utils
+
+    # Evaluation and upload happen once, on rank 0
+    if get_rank() != 0:
+        exit(0)
+
     ae_paths = utils.get_nested_folders(save_dir)
 
-    eval_saes(
-        args.model_name,
-        ae_paths,
-        demo_config.eval_num_inputs,
-        args.device,
-        overwrite_prev_results=True,
-    )
+    if not args.online_eval or args.posthoc_eval:
+        eval_saes(
+            args.model_name,
+            ae_paths,
+            demo_config.eval_num_inputs,
+            args.device,
+            overwrite_prev_results=True,
+            transcoder=args.transcoder,
+            relative_ci_widths=demo_config.eval_relative_ci_widths,
+            model=model,
+            input_strings=eval_input_strings,
+        )
 
     print(f"Total time: {time.time() - start_time}")
 
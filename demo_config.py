@@ -1,34 +1,47 @@
-from dataclasses import dataclass, asdict, field
-from typing import Optional, Type, Any
+from dataclasses import dataclass, asdict, field, replace
+from typing import Optional, Type, Any, Union
 from enum import Enum
-import torch as t
+from functools import cache
+import importlib
 import itertools
 
-from dictionary_learning.dictionary_learning.trainers.standard import (
-    StandardTrainer,
-    StandardTrainerAprilUpdate,
-)
-from dictionary_learning.dictionary_learning.trainers.top_k import (
-    TopKTrainer,
-    AutoEncoderTopK,
-)
-from dictionary_learning.dictionary_learning.trainers.batch_top_k import (
-    BatchTopKTrainer,
-    BatchTopKSAE,
-)
-from dictionary_learning.dictionary_learning.trainers.gdm import GatedSAETrainer
-from dictionary_learning.dictionary_learning.trainers.p_anneal import PAnnealTrainer
-from dictionary_learning.dictionary_learning.trainers.jumprelu import JumpReluTrainer
-from dictionary_learning.dictionary_learning.trainers.matryoshka_batch_top_k import (
-    MatryoshkaBatchTopKTrainer,
-    MatryoshkaBatchTopKSAE,
-)
-from dictionary_learning.dictionary_learning.dictionary import (
-    AutoEncoder,
-    GatedAutoEncoder,
-    AutoEncoderNew,
-    JumpReluAutoEncoder,
-)
+# Trainer and dictionary classes are referenced by name and only imported when trainer
+# configs are built for an actual run. This keeps importing demo_config (and running
+# `demo.py --help` or `--dry_run`) free of torch and dictionary_learning imports.
+DICTIONARY_LEARNING_PACKAGE = "dictionary_learning.dictionary_learning"
+CLASS_MODULES = {
+    "StandardTrainer": "trainers.standard",
+    "StandardTrainerAprilUpdate": "trainers.standard",
+    "TopKTrainer": "trainers.top_k",
+    "AutoEncoderTopK": "trainers.top_k",
+    "BatchTopKTrainer": "trainers.batch_top_k",
+    "BatchTopKSAE": "trainers.batch_top_k",
+    "GatedSAETrainer": "trainers.gdm",
+    "PAnnealTrainer": "trainers.p_anneal",
+    "JumpReluTrainer": "trainers.jumprelu",
+    "MatryoshkaBatchTopKTrainer": "trainers.matryoshka_batch_top_k",
+    "MatryoshkaBatchTopKSAE": "trainers.matryoshka_batch_top_k",
+    "AutoEncoder": "dictionary",
+    "GatedAutoEncoder": "dictionary",
+    "AutoEncoderNew": "dictionary",
+    "JumpReluAutoEncoder": "dictionary",
+}
+# Classes defined in this repo rather than in dictionary_learning
+LOCAL_CLASS_MODULES = {
+    "TranscoderTopKTrainer": "transcoder",
+    "TopKTranscoder": "transcoder",
+}
+
+
+@cache
+def resolve_class(name: str) -> Type[Any]:
+    if name in LOCAL_CLASS_MODULES:
+        module = importlib.import_module(LOCAL_CLASS_MODULES[name])
+    else:
+        module = importlib.import_module(
+            f"{DICTIONARY_LEARNING_PACKAGE}.{CLASS_MODULES[name]}"
+        )
+    return getattr(module, name)
 
 
 class TrainerType(Enum):
@@ -40,6 +53,11 @@ class TrainerType(Enum):
     P_ANNEAL = "p_anneal"
     JUMP_RELU = "jump_relu"
     Matryoshka_BATCH_TOP_K = "matryoshka_batch_top_k"
+    TRANSCODER_TOP_K = "transcoder_top_k"
+
+
+# Architectures trained on paired MLP input / output rows, used with --transcoder
+TRANSCODER_ARCHITECTURES = [TrainerType.TRANSCODER_TOP_K.value]
 
 
 @dataclass
@@ -47,7 +65,15 @@ class LLMConfig:
     llm_batch_size: int
     context_length: int
     sae_batch_size: int
-    dtype: t.dtype
+    dtype: str  # name of the torch dtype, see torch_dtype
+    # hidden_size of the model, lets --dry_run plan a sweep without fetching the model config
+    d_model: Optional[int] = None
+
+    @property
+    def torch_dtype(self):
+        import torch as t
+
+        return getattr(t, self.dtype)
 
 
 @dataclass
@@ -60,9 +86,25 @@ class SparsityPenalties:
 
 num_tokens = 500_000_000
 
-print(f"NOTE: Training on {num_tokens} tokens")
+# Number of leading positions of every context that are never stored in the activation
+# buffer. The first position has a very large norm (it acts as an attention sink), which
+# distorts activation normalization and wastes SAE steps. Opt-in: with 0, SAE runs use
+# dictionary_learning's ActivationBuffer as before. Padding is always dropped.
+sink_positions = 0
 
 eval_num_inputs = 200
+# Evaluation of each SAE stops early once the 95% confidence interval of every metric
+# is narrower than this fraction of its mean, up to eval_num_inputs.
+# Set to None to always evaluate on all eval_num_inputs. Every metric here must be
+# returned by the evaluation. Loss recovered is not a target: the truncated model has no
+# lm_head to score the patched forward with.
+eval_relative_ci_widths = {
+    "l0": 0.02,
+    "mse": 0.02,
+}
+eval_min_batches = 5
+# With --online_eval, SAEs are also evaluated at these fractions of training
+online_eval_fractions = [0.1, 0.5]
 random_seeds = [0]
 dictionary_widths = [2**14, 2**16]
 # dictionary_widths = [2**14]
@@ -77,16 +119,32 @@ wandb_project = "qwen-32b-sweep"
 
 LLM_CONFIG = {
     "EleutherAI/pythia-70m-deduped": LLMConfig(
-        llm_batch_size=64, context_length=1024, sae_batch_size=2048, dtype=t.float32
+        llm_batch_size=64,
+        context_length=1024,
+        sae_batch_size=2048,
+        dtype="float32",
+        d_model=512,
     ),
     "EleutherAI/pythia-160m-deduped": LLMConfig(
-        llm_batch_size=32, context_length=1024, sae_batch_size=2048, dtype=t.float32
+        llm_batch_size=32,
+        context_length=1024,
+        sae_batch_size=2048,
+        dtype="float32",
+        d_model=768,
     ),
     "google/gemma-2-2b": LLMConfig(
-        llm_batch_size=4, context_length=1024, sae_batch_size=2048, dtype=t.bfloat16
+        llm_batch_size=4,
+        context_length=1024,
+        sae_batch_size=2048,
+        dtype="bfloat16",
+        d_model=2304,
     ),
     "Qwen/Qwen2.5-Coder-32B-Instruct": LLMConfig(
-        llm_batch_size=4, context_length=2048, sae_batch_size=2048, dtype=t.bfloat16
+        llm_batch_size=4,
+        context_length=2048,
+        sae_batch_size=2048,
+        dtype="bfloat16",
+        d_model=5120,
     ),
 }
 
@@ -101,6 +159,44 @@ SPARSITY_PENALTIES = SparsityPenalties(
 TARGET_L0s = [80, 160]
 # TARGET_L0s = [20, 40, 80, 160, 320, 640]
 
+# With --calibrate_penalties, the SPARSITY_PENALTIES of each architecture are replaced by
+# one penalty per TARGET_L0s, found by bisection on log-penalty with short pilot runs on
+# cached activations. The pilots' schedules are scaled down to calibration_pilot_steps.
+# A bracket that does not contain its target L0 is widened up to
+# calibration_max_bracket_expansions times before bisecting.
+calibration_pilot_steps = 2000
+calibration_rounds = 6
+calibration_cache_batches = 100
+calibration_eval_batches = 8
+calibration_max_bracket_expansions = 4
+
+# Architectures whose sparsity is set by a penalty rather than by k or a target L0
+CALIBRATED_ARCHITECTURES = [
+    TrainerType.STANDARD.value,
+    TrainerType.STANDARD_NEW.value,
+    TrainerType.P_ANNEAL.value,
+    TrainerType.GATED.value,
+]
+
+
+def placeholder_calibrated_penalties(
+    architectures: list[str], dict_sizes: list[int]
+) -> dict[int, SparsityPenalties]:
+    """
+    Stand-in for calibration.calibrate_sparsity_penalties when planning a run: one NaN
+    penalty per TARGET_L0s for every calibrated architecture, so the number and order
+    of trainer configs match the calibrated run.
+    """
+    placeholder = replace(
+        SPARSITY_PENALTIES,
+        **{
+            architecture: [float("nan")] * len(TARGET_L0s)
+            for architecture in architectures
+            if architecture in CALIBRATED_ARCHITECTURES
+        },
+    )
+    return {dict_size: placeholder for dict_size in dict_sizes}
+
 
 @dataclass
 class BaseTrainerConfig:
@@ -109,8 +205,8 @@ class BaseTrainerConfig:
     layer: str
     lm_name: str
     submodule_name: str
-    trainer: Type[Any]
-    dict_class: Type[Any]
+    trainer: Union[str, Type[Any]]
+    dict_class: Union[str, Type[Any]]
     wandb_name: str
     warmup_steps: int
     steps: int
@@ -184,6 +280,15 @@ class MatryoshkaBatchTopKTrainerConfig(BaseTrainerConfig):
     threshold_start_step: int = 1000  # when to begin tracking the average threshold
 
 
+@dataclass
+class TranscoderTopKTrainerConfig(BaseTrainerConfig):
+    dict_size: int
+    seed: int
+    lr: float
+    k: int
+    auxk_alpha: float = 1 / 32
+
+
 @dataclass
 class GatedTrainerConfig(BaseTrainerConfig):
     dict_size: int
@@ -218,9 +323,29 @@ def get_trainer_configs(
     warmup_steps: int = WARMUP_STEPS,
     sparsity_warmup_steps: int = SPARSITY_WARMUP_STEPS,
     decay_start_fraction=DECAY_START_FRACTION,
+    resolve_classes: bool = True,
+    sparsity_penalties: Optional[dict[int, SparsityPenalties]] = None,
 ) -> list[dict]:
+    """
+    If resolve_classes is False, the trainer and dict_class entries are left as class
+    names, which is enough to plan a sweep without importing any trainer code.
+
+    sparsity_penalties maps a dict size to the penalties to use for it (e.g. from
+    calibration.calibrate_sparsity_penalties). Other dict sizes use SPARSITY_PENALTIES.
+    """
     decay_start = int(steps * decay_start_fraction)
 
+    def penalty_sweep(architecture: str):
+        """Same order as itertools.product(seeds, dict_sizes, learning_rates, penalties)."""
+        for seed, dict_size, learning_rate in itertools.product(
+            seeds, dict_sizes, learning_rates
+        ):
+            penalties = SPARSITY_PENALTIES
+            if sparsity_penalties is not None and dict_size in sparsity_penalties:
+                penalties = sparsity_penalties[dict_size]
+            for penalty in getattr(penalties, architecture):
+                yield seed, dict_size, learning_rate, penalty
+
     trainer_configs = []
 
     base_config = {
@@ -234,13 +359,11 @@ def get_trainer_configs(
         "submodule_name": submodule_name,
     }
     if TrainerType.P_ANNEAL.value in architectures:
-        for seed, dict_size, learning_rate, sparsity_penalty in itertools.product(
-            seeds, dict_sizes, learning_rates, SPARSITY_PENALTIES.p_anneal
-        ):
+        for seed, dict_size, learning_rate, sparsity_penalty in penalty_sweep("p_anneal"):
             config = PAnnealTrainerConfig(
                 **base_config,
-                trainer=PAnnealTrainer,
-                dict_class=AutoEncoder,
+                trainer="PAnnealTrainer",
+                dict_class="AutoEncoder",
                 sparsity_warmup_steps=sparsity_warmup_steps,
                 lr=learning_rate,
                 dict_size=dict_size,
@@ -251,13 +374,11 @@ def get_trainer_configs(
             trainer_configs.append(asdict(config))
 
     if TrainerType.STANDARD.value in architectures:
-        for seed, dict_size, learning_rate, l1_penalty in itertools.product(
-            seeds, dict_sizes, learning_rates, SPARSITY_PENALTIES.standard
-        ):
+        for seed, dict_size, learning_rate, l1_penalty in penalty_sweep("standard"):
             config = StandardTrainerConfig(
                 **base_config,
-                trainer=StandardTrainer,
-                dict_class=AutoEncoder,
+                trainer="StandardTrainer",
+                dict_class="AutoEncoder",
                 sparsity_warmup_steps=sparsity_warmup_steps,
                 lr=learning_rate,
                 dict_size=dict_size,
@@ -268,13 +389,11 @@ def get_trainer_configs(
             trainer_configs.append(asdict(config))
 
     if TrainerType.STANDARD_NEW.value in architectures:
-        for seed, dict_size, learning_rate, l1_penalty in itertools.product(
-            seeds, dict_sizes, learning_rates, SPARSITY_PENALTIES.standard_new
-        ):
+        for seed, dict_size, learning_rate, l1_penalty in penalty_sweep("standard_new"):
             config = StandardNewTrainerConfig(
                 **base_config,
-                trainer=StandardTrainerAprilUpdate,
-                dict_class=AutoEncoder,
+                trainer="StandardTrainerAprilUpdate",
+                dict_class="AutoEncoder",
                 sparsity_warmup_steps=sparsity_warmup_steps,
                 lr=learning_rate,
                 dict_size=dict_size,
@@ -285,13 +404,11 @@ def get_trainer_configs(
             trainer_configs.append(asdict(config))
 
     if TrainerType.GATED.value in architectures:
-        for seed, dict_size, learning_rate, l1_penalty in itertools.product(
-            seeds, dict_sizes, learning_rates, SPARSITY_PENALTIES.gated
-        ):
+        for seed, dict_size, learning_rate, l1_penalty in penalty_sweep("gated"):
             config = GatedTrainerConfig(
                 **base_config,
-                trainer=GatedSAETrainer,
-                dict_class=GatedAutoEncoder,
+                trainer="GatedSAETrainer",
+                dict_class="GatedAutoEncoder",
                 sparsity_warmup_steps=sparsity_warmup_steps,
                 lr=learning_rate,
                 dict_size=dict_size,
@@ -307,8 +424,8 @@ def get_trainer_configs(
         ):
             config = TopKTrainerConfig(
                 **base_config,
-                trainer=TopKTrainer,
-                dict_class=AutoEncoderTopK,
+                trainer="TopKTrainer",
+                dict_class="AutoEncoderTopK",
                 lr=learning_rate,
                 dict_size=dict_size,
                 seed=seed,
@@ -323,8 +440,8 @@ def get_trainer_configs(
         ):
             config = TopKTrainerConfig(
                 **base_config,
-                trainer=BatchTopKTrainer,
-                dict_class=BatchTopKSAE,
+                trainer="BatchTopKTrainer",
+                dict_class="BatchTopKSAE",
                 lr=learning_rate,
                 dict_size=dict_size,
                 seed=seed,
@@ -339,8 +456,8 @@ def get_trainer_configs(
         ):
             config = MatryoshkaBatchTopKTrainerConfig(
                 **base_config,
-                trainer=MatryoshkaBatchTopKTrainer,
-                dict_class=MatryoshkaBatchTopKSAE,
+                trainer="MatryoshkaBatchTopKTrainer",
+                dict_class="MatryoshkaBatchTopKSAE",
                 lr=learning_rate,
                 dict_size=dict_size,
                 seed=seed,
@@ -355,8 +472,8 @@ def get_trainer_configs(
         ):
             config = JumpReluTrainerConfig(
                 **base_config,
-                trainer=JumpReluTrainer,
-                dict_class=JumpReluAutoEncoder,
+                trainer="JumpReluTrainer",
+                dict_class="JumpReluAutoEncoder",
                 sparsity_warmup_steps=sparsity_warmup_steps,
                 lr=learning_rate,
                 dict_size=dict_size,
@@ -366,4 +483,36 @@ def get_trainer_configs(
             )
             trainer_configs.append(asdict(config))
 
+    if TrainerType.TRANSCODER_TOP_K.value in architectures:
+        for seed, dict_size, learning_rate, k in itertools.product(
+            seeds, dict_sizes, learning_rates, TARGET_L0s
+        ):
+            config = TranscoderTopKTrainerConfig(
+                **base_config,
+                trainer="TranscoderTopKTrainer",
+                dict_class="TopKTranscoder",
+                lr=learning_rate,
+                dict_size=dict_size,
+                seed=seed,
+                k=k,
+                wandb_name=f"TranscoderTopKTrainer-{model_name}-{submodule_name}",
+            )
+            trainer_configs.append(asdict(config))
+
+    if resolve_classes:
+        for config in trainer_configs:
+            config["trainer"] = resolve_class(config["trainer"])
+            config["dict_class"] = resolve_class(config["dict_class"])
+
     return trainer_configs
+
+
+def get_activation_dim(model_name: str) -> int:
+    d_model = LLM_CONFIG[model_name].d_model
+    if d_model is not None:
+        return d_model
+
+    # Only downloads config.json, not the weights
+    from transformers import AutoConfig
+
+    return AutoConfig.from_pretrained(model_name).hidden_size
@@ -0,0 +1,185 @@
+import gc
+from typing import Optional
+
+import torch as t
+from transformers import AutoConfig, AutoModelForCausalLM
+
+
+class EarlyExitException(Exception):
+    """Raised from a forward hook once every requested activation has been captured."""
+
+    pass
+
+
+def find_decoder_layers(model: t.nn.Module) -> tuple[str, t.nn.ModuleList]:
+    """
+    Returns the dotted name and module of the decoder layer list, without relying on
+    a per-architecture whitelist. We look for a ModuleList of identically typed blocks,
+    preferring one whose length matches config.num_hidden_layers.
+    """
+    config = getattr(model, "config", None)
+    if config is not None and hasattr(config, "get_text_config"):
+        config = config.get_text_config()
+    num_layers = getattr(config, "num_hidden_layers", None)
+
+    candidates = []
+    for name, module in model.named_modules():
+        if not isinstance(module, t.nn.ModuleList) or len(module) == 0:
+            continue
+        if len({type(block) for block in module}) != 1:
+            continue
+        candidates.append((name, module))
+
+    if not candidates:
+        raise ValueError(f"Could not find decoder layers in {type(model).__name__}")
+
+    matching = [c for c in candidates if len(c[1]) == num_layers]
+    if matching:
+        candidates = matching
+
+    return max(candidates, key=lambda c: len(c[1]))
+
+
+def get_layer(model: t.nn.Module, layer: int) -> t.nn.Module:
+    _, layers = find_decoder_layers(model)
+    return layers[layer]
+
+
+def _replace_module(model: t.nn.Module, name: str, new_module: t.nn.Module) -> None:
+    parent_name, _, attr = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, attr, new_module)
+
+
+def _truncate_config(config, layer: int) -> None:
+    if hasattr(config, "get_text_config"):
+        config = config.get_text_config()
+    config.num_hidden_layers = layer + 1
+    # Some configs (e.g. Gemma2 in recent transformers) store per-layer attention types
+    if getattr(config, "layer_types", None) is not None:
+        config.layer_types = config.layer_types[: layer + 1]
+
+
+def truncate_model(model: AutoModelForCausalLM, layer: int) -> AutoModelForCausalLM:
+    """
+    Architecture-agnostic replacement for utils.truncate_model. Drops every decoder layer
+    after `layer` and the unembedding. The final norm is kept, but it is never run when
+    activations are collected with collect_activations.
+    """
+    total_params_before = sum(p.numel() for p in model.parameters())
+
+    name, layers = find_decoder_layers(model)
+    if layer >= len(layers):
+        raise ValueError(f"Layer {layer} out of range for {len(layers)} decoder layers")
+
+    _replace_module(model, name, layers[: layer + 1])
+    _truncate_config(model.config, layer)
+
+    # With tied embeddings the shared weight stays alive through the input embeddings,
+    # so dropping the lm_head module is safe either way
+    output_embeddings = model.get_output_embeddings()
+    if output_embeddings is not None:
+        for child_name, child in model.named_modules():
+            if child is output_embeddings:
+                _replace_module(model, child_name, t.nn.Identity())
+                break
+
+    del layers, output_embeddings
+    gc.collect()
+    if t.cuda.is_available():
+        t.cuda.empty_cache()
+
+    total_params_after = sum(p.numel() for p in model.parameters())
+    print(
+        f"Model parameters before truncation: {total_params_before:,}, after: {total_params_after:,}"
+    )
+
+    return model
+
+
+def load_truncated_model(
+    model_name: str,
+    layer: int,
+    dtype: t.dtype,
+    device_map: Optional[str | dict] = "auto",
+) -> AutoModelForCausalLM:
+    """
+    Loads only the first `layer + 1` decoder layers. Weights of later layers are
+    present in the checkpoint but are never materialized, which saves both I/O
+    and peak memory compared to loading the full model and truncating it.
+    """
+    config = AutoConfig.from_pretrained(model_name)
+    _truncate_config(config, layer)
+
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, config=config, device_map=device_map, torch_dtype=dtype
+    )
+
+    return truncate_model(model, layer)
+
+
+def _get_activation(args: tuple, kwargs: dict, output, io: str) -> t.Tensor:
+    if io == "in":
+        return args[0] if args else kwargs["hidden_states"]
+    if io == "out":
+        return output[0] if isinstance(output, tuple) else output
+    raise ValueError(f"Unknown io: {io}")
+
+
+def collect_activations(
+    model: t.nn.Module,
+    submodules: list[t.nn.Module],
+    inputs: dict[str, t.Tensor],
+    io: str = "out",
+) -> list[t.Tensor]:
+    """
+    Runs the forward pass only as far as needed to capture `io` of every submodule,
+    then stops. Works for any architecture: the forward is aborted as soon as the
+    last (i.e. deepest) hooked submodule has fired, so later layers, the final norm
+    and the unembedding are never run.
+
+    io can be "in", "out" or "in_and_out". For "in_and_out", each returned tensor
+    has shape (batch, seq, 2, d) with the input and output of the same submodule
+    captured in a single pass.
+    """
+    captured: dict[int, t.Tensor] = {}
+
+    def make_hook(i: int):
+        def hook(module, args, kwargs, output):
+            if io == "in_and_out":
+                captured[i] = t.stack(
+                    [
+                        _get_activation(args, kwargs, output, "in"),
+                        _get_activation(args, kwargs, output, "out"),
+                    ],
+                    dim=-2,
+                )
+            else:
+                captured[i] = _get_activation(args, kwargs, output, io)
+
+            if len(captured) == len(submodules):
+                raise EarlyExitException()
+
+        return hook
+
+    handles = [
+        submodule.register_forward_hook(make_hook(i), with_kwargs=True)
+        for i, submodule in enumerate(submodules)
+    ]
+
+    try:
+        model(**inputs)
+    except EarlyExitException:
+        pass
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return [captured[i] for i in range(len(submodules))]
+
+
+def get_mlp(model: t.nn.Module, layer: int) -> t.nn.Module:
+    block = get_layer(model, layer)
+    if not hasattr(block, "mlp"):
+        raise ValueError(f"{type(block).__name__} has no mlp submodule")
+    return block.mlp
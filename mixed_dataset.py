@@ -0,0 +1,329 @@
+import copy
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+# Sentinel put on a source's queue when its iterator is exhausted
+_END_OF_SOURCE = object()
+
+
+@dataclass
+class SourceStats:
+    samples: int = 0
+    tokens: int = 0
+    # Time the mixer spent blocked waiting for this source
+    wait_seconds: float = 0.0
+    start_time: float = field(default_factory=time.time)
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / max(time.time() - self.start_time, 1e-9)
+
+
+class SourcePrefetcher:
+    """
+    Reads one source in a background thread into a bounded queue, counting the tokens of
+    each sample as it goes. A slow or retrying source only stalls the mixer when its queue
+    runs dry, and the other sources keep prefetching in the meantime.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        make_iter: Callable[[], Iterable[str]],
+        count_tokens: Callable[[str], int],
+        queue_size: int = 256,
+    ):
+        self.name = name
+        self.make_iter = make_iter
+        self.count_tokens = count_tokens
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self._worker, name=f"prefetch-{name}", daemon=True
+        )
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self):
+        try:
+            for text in self.make_iter():
+                if not self._put((text, self.count_tokens(text))):
+                    return
+        except Exception as e:
+            # Re-raised in the consumer thread by get()
+            self._put(e)
+            return
+        self._put(_END_OF_SOURCE)
+
+    def get(self):
+        """Returns (text, num_tokens), or _END_OF_SOURCE when the source is exhausted."""
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stop_event.set()
+
+
+class TokenRatioMixer:
+    """
+    Mixes several text sources so that each source contributes exactly its fraction of
+    the *tokens* (rather than of the samples) seen so far. At every step we draw from the
+    source that is furthest behind its target share. Iteration stops when any source is
+    exhausted, as the ratio can no longer be kept.
+
+    Sources are factories returning iterables of strings, so local lists or files work as
+    stand-ins for streaming datasets. count_tokens runs in the prefetch threads, and can be
+    a dict with one counter per source so that no counter is shared between threads.
+    """
+
+    def __init__(
+        self,
+        sources: dict[str, Callable[[], Iterable[str]]],
+        fractions: dict[str, float],
+        count_tokens: Union[Callable[[str], int], dict[str, Callable[[str], int]]],
+        queue_size: int = 256,
+    ):
+        if set(sources) != set(fractions):
+            raise ValueError("sources and fractions must have the same keys")
+        if any(frac < 0 for frac in fractions.values()):
+            raise ValueError("fractions must be non-negative")
+
+        # Sources with a zero fraction are never read, so don't start their workers
+        fractions = {name: frac for name, frac in fractions.items() if frac > 0}
+        sources = {name: sources[name] for name in fractions}
+        if not isinstance(count_tokens, dict):
+            count_tokens = {name: count_tokens for name in sources}
+
+        total = sum(fractions.values())
+        self.fractions = {name: frac / total for name, frac in fractions.items()}
+        self.stats = {name: SourceStats() for name in sources}
+        self.prefetchers = {
+            name: SourcePrefetcher(name, make_iter, count_tokens[name], queue_size)
+            for name, make_iter in sources.items()
+        }
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self.finished:
+            raise StopIteration
+
+        # Source with the smallest share of tokens relative to its target fraction
+        name = min(
+            self.fractions,
+            key=lambda n: self.stats[n].tokens / self.fractions[n],
+        )
+
+        start = time.time()
+        item = self.prefetchers[name].get()
+        stats = self.stats[name]
+        stats.wait_seconds += time.time() - start
+
+        if item is _END_OF_SOURCE:
+            self.close()
+            raise StopIteration
+
+        text, num_tokens = item
+        stats.samples += 1
+        stats.tokens += num_tokens
+        return text
+
+    def token_fractions(self) -> dict[str, float]:
+        total = max(sum(s.tokens for s in self.stats.values()), 1)
+        return {name: s.tokens / total for name, s in self.stats.items()}
+
+    def report(self) -> str:
+        fractions = self.token_fractions()
+        return "\n".join(
+            f"{name}: {s.samples:,} samples, {s.tokens:,} tokens "
+            f"({fractions[name]:.3f} of tokens), {s.tokens_per_second:,.0f} tokens / second, "
+            f"waited {s.wait_seconds:.1f}s"
+            for name, s in self.stats.items()
+        )
+
+    def close(self):
+        self.finished = True
+        for prefetcher in self.prefetchers.values():
+            prefetcher.close()
+
+
+def pack_texts(texts: Iterable[str], min_chars: int, separator: str = "") -> Iterator[str]:
+    """Concatenates consecutive documents until each packed sample has at least min_chars."""
+    packed = []
+    packed_chars = 0
+    for text in texts:
+        packed.append(text)
+        packed_chars += len(text)
+        if packed_chars >= min_chars:
+            yield separator.join(packed)
+            packed = []
+            packed_chars = 0
+
+
+def format_chats(
+    conversations: Iterable[list[dict]],
+    tokenizer,
+    system_prompt_to_remove: Optional[str] = None,
+) -> Iterator[str]:
+    for conversation in conversations:
+        text = tokenizer.apply_chat_template(conversation, tokenize=False)
+        if system_prompt_to_remove is not None:
+            text = text.replace(system_prompt_to_remove, "")
+        yield text
+
+
+def load_stream(dataset_name: str, split: str = "train", rank: int = 0, world_size: int = 1):
+    """
+    Streams a Hugging Face dataset. With world_size > 1 only this rank's part is read
+    (whole files when the number of files divides evenly, otherwise every world_size-th
+    row), so ranks don't all download and tokenize the full stream.
+    """
+    from datasets import load_dataset
+
+    dataset = load_dataset(dataset_name, split=split, streaming=True)
+    if world_size > 1:
+        from datasets.distributed import split_dataset_by_node
+
+        dataset = split_dataset_by_node(dataset, rank=rank, world_size=world_size)
+    return dataset
+
+
+def pretrain_source(
+    tokenizer,
+    pretrain_dataset: str = "HuggingFaceFW/fineweb",
+    min_chars: int = 1,
+    split: str = "train",
+    pretrain_key: str = "text",
+    sequence_pack_pretrain: bool = True,
+    rank: int = 0,
+    world_size: int = 1,
+) -> Callable[[], Iterable[str]]:
+    """Factory of pretraining texts, packed with EOS separators to at least min_chars."""
+
+    def pretrain_texts():
+        dataset = load_stream(pretrain_dataset, split, rank, world_size)
+        texts = (row[pretrain_key] for row in dataset)
+        if sequence_pack_pretrain:
+            return pack_texts(texts, min_chars, separator=tokenizer.eos_token or "")
+        return (text for text in texts if len(text) >= min_chars)
+
+    return pretrain_texts
+
+
+def mixed_dataset_sources(
+    tokenizer,
+    pretrain_dataset: str = "HuggingFaceFW/fineweb",
+    chat_dataset: str = "lmsys/lmsys-chat-1m",
+    min_chars: int = 1,
+    pretrain_frac: float = 0.9,
+    split: str = "train",
+    pretrain_key: str = "text",
+    chat_key: str = "conversation",
+    sequence_pack_pretrain: bool = True,
+    system_prompt_to_remove: Optional[str] = None,
+    rank: int = 0,
+    world_size: int = 1,
+) -> tuple[dict[str, Callable[[], Iterable[str]]], dict[str, float]]:
+    """
+    The pretrain and chat sources of parallel_mixed_dataset_to_generator and their token
+    fractions, so they can also be counted separately (see token_census.py). With
+    world_size > 1, both sources only read this rank's part of their dataset. Each source
+    uses its own copy of the tokenizer, as the sources are read in separate threads.
+    """
+    pretrain_texts = pretrain_source(
+        copy.deepcopy(tokenizer),
+        pretrain_dataset=pretrain_dataset,
+        min_chars=min_chars,
+        split=split,
+        pretrain_key=pretrain_key,
+        sequence_pack_pretrain=sequence_pack_pretrain,
+        rank=rank,
+        world_size=world_size,
+    )
+
+    chat_tokenizer = copy.deepcopy(tokenizer)
+
+    def chat_texts():
+        dataset = load_stream(chat_dataset, split, rank, world_size)
+        return format_chats(
+            (row[chat_key] for row in dataset), chat_tokenizer, system_prompt_to_remove
+        )
+
+    sources = {"pretrain": pretrain_texts, "chat": chat_texts}
+    fractions = {"pretrain": pretrain_frac, "chat": 1 - pretrain_frac}
+    return sources, fractions
+
+
+def parallel_mixed_dataset_to_generator(
+    tokenizer,
+    pretrain_dataset: str = "HuggingFaceFW/fineweb",
+    chat_dataset: str = "lmsys/lmsys-chat-1m",
+    min_chars: int = 1,
+    pretrain_frac: float = 0.9,
+    split: str = "train",
+    pretrain_key: str = "text",
+    chat_key: str = "conversation",
+    sequence_pack_pretrain: bool = True,
+    system_prompt_to_remove: Optional[str] = None,
+    max_tokens_per_sample: Optional[int] = None,
+    queue_size: int = 256,
+    rank: int = 0,
+    world_size: int = 1,
+) -> TokenRatioMixer:
+    """
+    Parallel version of hf_mixed_dataset_to_generator. Each dataset streams in its own
+    prefetch thread, and pretrain_frac is enforced on token counts. Set
+    max_tokens_per_sample to the context length so that tokens which will be truncated
+    away do not count towards the mixture. Under torchrun, pass the rank and world size
+    so each rank mixes its own part of both datasets.
+
+    Each prefetch thread counts tokens with its own copy of `tokenizer`. A fast tokenizer
+    shared between threads can fail with "Already borrowed" or pick up another caller's
+    truncation settings, so the caller's tokenizer (e.g. the activation buffer's) is never
+    used from the prefetch threads.
+    """
+
+    def make_count_tokens(tokenizer) -> Callable[[str], int]:
+        def count_tokens(text: str) -> int:
+            num_tokens = len(tokenizer(text, add_special_tokens=False)["input_ids"])
+            if max_tokens_per_sample is not None:
+                num_tokens = min(num_tokens, max_tokens_per_sample)
+            return num_tokens
+
+        return count_tokens
+
+    sources, fractions = mixed_dataset_sources(
+        tokenizer,
+        pretrain_dataset=pretrain_dataset,
+        chat_dataset=chat_dataset,
+        min_chars=min_chars,
+        pretrain_frac=pretrain_frac,
+        split=split,
+        pretrain_key=pretrain_key,
+        chat_key=chat_key,
+        sequence_pack_pretrain=sequence_pack_pretrain,
+        system_prompt_to_remove=system_prompt_to_remove,
+        rank=rank,
+        world_size=world_size,
+    )
+    return TokenRatioMixer(
+        sources=sources,
+        fractions=fractions,
+        count_tokens={name: make_count_tokens(copy.deepcopy(tokenizer)) for name in sources},
+        queue_size=queue_size,
+    )
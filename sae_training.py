@@ -0,0 +1,314 @@
+"""
+A minimal version of dictionary_learning's trainSAE that can also run data-parallel
+with torch.distributed. Launch with torchrun, e.g.
+
+torchrun --nproc_per_node 4 demo.py --save_dir ./saes --model_name Qwen/Qwen2.5-Coder-32B-Instruct --layers 32 --architectures batch_top_k
+
+Each rank runs its own activation buffer over a disjoint part of the dataset (see
+mixed_dataset.load_stream).
+Gradients are averaged across ranks during backward, so every rank applies the same
+optimizer step and the dictionaries stay in sync. Only rank 0 writes to disk.
+"""
+
+import os
+import copy
+import json
+import time
+import itertools
+from contextlib import nullcontext
+from typing import Callable, Iterator, Optional, Union
+
+import torch as t
+import torch.distributed as dist
+
+# Trainer state that is derived from the local batch and must be combined across ranks.
+# The BatchTopK / TopK threshold is an EMA of the minimum positive activation, so after
+# identical EMA updates a MIN all-reduce gives exactly the EMA of the global minimum.
+MIN_REDUCED_AE_BUFFERS = ["threshold"]
+# Dead feature counters: a feature fired on any rank resets the global counter.
+MIN_REDUCED_TRAINER_COUNTERS = ["num_tokens_since_fired", "steps_since_active"]
+# Counters measured in tokens advance by world_size times the local amount per step.
+TOKEN_COUNTERS = ["num_tokens_since_fired"]
+# Trainers with other state adapted from the local batch, which is not synced. E.g.
+# PAnnealTrainer's sparsity_coeff follows its queue of local batch sparsities.
+UNSYNCED_TRAINERS = ["PAnnealTrainer"]
+
+
+def init_distributed(backend: Optional[str] = None) -> tuple[int, int]:
+    """Initializes the process group when launched with torchrun. Returns (rank, world_size)."""
+    if int(os.environ.get("WORLD_SIZE", 1)) == 1:
+        return 0, 1
+
+    if not dist.is_initialized():
+        if backend is None:
+            backend = "nccl" if t.cuda.is_available() else "gloo"
+        if backend == "nccl":
+            # Bind the rank to its GPU before the first collective, so NCCL (e.g. in
+            # barrier) doesn't have to guess the device
+            t.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+        dist.init_process_group(backend)
+
+    return dist.get_rank(), dist.get_world_size()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def get_local_device(device: str) -> str:
+    """Each rank gets its own GPU. On CPU (gloo), every rank uses the CPU."""
+    if not dist.is_initialized() or not device.startswith("cuda"):
+        return device
+    return f"cuda:{os.environ.get('LOCAL_RANK', 0)}"
+
+
+def _register_grad_all_reduce(module: t.nn.Module, world_size: int) -> list:
+    def hook(grad: t.Tensor) -> t.Tensor:
+        grad = grad.contiguous()
+        dist.all_reduce(grad, op=dist.ReduceOp.SUM)
+        return grad / world_size
+
+    return [p.register_hook(hook) for p in module.parameters() if p.requires_grad]
+
+
+def _broadcast_state(module: t.nn.Module) -> None:
+    for tensor in itertools.chain(module.parameters(), module.buffers()):
+        dist.broadcast(tensor.data, src=0)
+
+
+def _snapshot_counters(trainer) -> dict[str, t.Tensor]:
+    return {
+        name: getattr(trainer, name).clone()
+        for name in MIN_REDUCED_TRAINER_COUNTERS
+        if isinstance(getattr(trainer, name, None), t.Tensor)
+    }
+
+
+def _sync_trainer_state(trainer, counters_before: dict[str, t.Tensor], world_size: int):
+    for name in MIN_REDUCED_AE_BUFFERS:
+        buffer = getattr(trainer.ae, name, None)
+        if isinstance(buffer, t.Tensor):
+            dist.all_reduce(buffer.data, op=dist.ReduceOp.MIN)
+
+    for name, before in counters_before.items():
+        counter = getattr(trainer, name)
+        dist.all_reduce(counter, op=dist.ReduceOp.MIN)
+        if name in TOKEN_COUNTERS:
+            # Features that fired nowhere have advanced by the global number of tokens
+            not_fired = counter > before
+            counter[not_fired] += (world_size - 1) * (counter - before)[not_fired]
+
+
+@t.no_grad()
+def get_norm_factor(data: Iterator[t.Tensor], steps: int) -> Union[float, list[float]]:
+    """
+    Per Section 3.1 of the April update, find a fixed scalar so that activations have
+    unit mean squared norm. Averaged across ranks when running distributed.
+
+    For paired (batch, 2, d) transcoder batches, the input and output of the submodule
+    have very different norms, so [input_factor, output_factor] is returned instead.
+    """
+    total_mean_squared_norm = 0.0
+    for _ in range(steps):
+        act = next(data)
+        # () for plain batches, (2,) for paired batches
+        total_mean_squared_norm += act.float().pow(2).sum(dim=-1).mean(dim=0).cpu()
+
+    mean_squared_norm = t.as_tensor(total_mean_squared_norm / steps)
+    if dist.is_initialized():
+        if dist.get_backend() == "nccl":
+            mean_squared_norm = mean_squared_norm.cuda()
+        # gloo does not support ReduceOp.AVG
+        dist.all_reduce(mean_squared_norm, op=dist.ReduceOp.SUM)
+        mean_squared_norm /= dist.get_world_size()
+
+    norm_factor = t.sqrt(mean_squared_norm).tolist()
+    print(f"Average squared norm: {mean_squared_norm.tolist()}, norm factor: {norm_factor}")
+    return norm_factor
+
+
+def normalize(act: t.Tensor, norm_factor: Union[float, list[float]]) -> t.Tensor:
+    """Divides a batch by the norm factor from get_norm_factor, per side for pairs."""
+    if isinstance(norm_factor, list):
+        return act / t.tensor(norm_factor, dtype=act.dtype, device=act.device)[:, None]
+    return act / norm_factor
+
+
+def raw_copy(ae: t.nn.Module, norm_factor: Optional[Union[float, list[float]]]):
+    """
+    Copy of `ae` scaled to work on raw activations. The live module is never rescaled
+    during training: scaling there and back adds round-off on one rank only, and the
+    replicas would drift apart.
+    """
+    ae = copy.deepcopy(ae)
+    if norm_factor is not None:
+        ae.scale_biases(norm_factor)
+    return ae
+
+
+def save_trainer(
+    trainer,
+    save_dir: str,
+    filename: str = "ae.pt",
+    norm_factor: Optional[Union[float, list[float]]] = None,
+) -> None:
+    """Saves the dictionary, scaled to raw activations if norm_factor is given."""
+    os.makedirs(save_dir, exist_ok=True)
+    ae = trainer.ae if norm_factor is None else raw_copy(trainer.ae, norm_factor)
+    checkpoint = {k: v.cpu() for k, v in ae.state_dict().items()}
+    t.save(checkpoint, os.path.join(save_dir, filename))
+
+
+def build_trainers(
+    trainer_configs: list[dict], indices: Optional[list[int]] = None
+) -> list:
+    """`indices` are the positions of the configs in the full sweep, used for naming."""
+    if indices is None:
+        indices = list(range(len(trainer_configs)))
+
+    trainers = []
+    for i, config in zip(indices, trainer_configs):
+        config = dict(config)
+        if "wandb_name" in config:
+            config["wandb_name"] = f"{config['wandb_name']}_trainer_{i}"
+        trainer_class = config.pop("trainer")
+        trainers.append(trainer_class(**config))
+    return trainers
+
+
+def train_saes(
+    data: Iterator[t.Tensor],
+    trainer_configs: list[dict],
+    steps: int,
+    save_dir: Optional[str] = None,
+    save_steps: Optional[list[int]] = None,
+    log_steps: Optional[int] = None,
+    normalize_activations: bool = False,
+    autocast_dtype: t.dtype = t.float32,
+    buffer_config: Optional[dict] = None,
+    eval_steps: Optional[list[int]] = None,
+    eval_fn: Optional[Callable[[int, list], None]] = None,
+    backup_steps: Optional[int] = None,
+) -> list:
+    """
+    Trains every config in `trainer_configs` on the same stream of activations.
+    When torch.distributed is initialized, `data` must already be this rank's part of
+    the dataset (see mixed_dataset.load_stream), and every rank must use the same seed so the dictionaries
+    start identical.
+
+    If `eval_fn` is given, it is called on rank 0 as eval_fn(step, dictionaries) at
+    every step in `eval_steps` and once more with step == steps after training, with
+    the dictionaries scaled to raw activations.
+
+    Every `backup_steps`, rank 0 saves each dictionary to trainer_i/ae.pt so an
+    interrupted run keeps its progress. Unlike trainSAE, there is no wandb logging.
+    """
+    rank = get_rank()
+    world_size = get_world_size()
+    distributed = world_size > 1
+
+    if distributed:
+        unsynced = {config["trainer"].__name__ for config in trainer_configs}
+        unsynced &= set(UNSYNCED_TRAINERS)
+        if unsynced:
+            raise ValueError(f"{sorted(unsynced)} can't be trained data-parallel")
+
+    trainers = build_trainers(trainer_configs)
+
+    if buffer_config is None and hasattr(data, "config"):
+        buffer_config = data.config
+
+    grad_hooks = []
+    if distributed:
+        for trainer in trainers:
+            _broadcast_state(trainer.ae)
+            grad_hooks.extend(_register_grad_all_reduce(trainer.ae, world_size))
+
+    norm_factor = None
+    if normalize_activations:
+        norm_factor = get_norm_factor(data, steps=100)
+
+    if save_dir is not None and rank == 0:
+        for i, trainer in enumerate(trainers):
+            trainer_dir = os.path.join(save_dir, f"trainer_{i}")
+            os.makedirs(trainer_dir, exist_ok=True)
+            config = {"trainer": trainer.config}
+            if norm_factor is not None:
+                config["trainer"]["norm_factor"] = norm_factor
+            if buffer_config is not None:
+                config["buffer"] = {**buffer_config, "world_size": world_size}
+            with open(os.path.join(trainer_dir, "config.json"), "w") as f:
+                json.dump(config, f, indent=4)
+
+    device = trainers[0].device if hasattr(trainers[0], "device") else "cpu"
+    device_type = "cuda" if "cuda" in str(device) else "cpu"
+    autocast_context = (
+        nullcontext()
+        if autocast_dtype == t.float32
+        else t.autocast(device_type=device_type, dtype=autocast_dtype)
+    )
+
+    start_time = time.time()
+
+    for step, act in enumerate(data):
+        if step >= steps:
+            break
+
+        act = act.to(dtype=t.float32)
+        if normalize_activations:
+            act = normalize(act, norm_factor)
+
+        if save_steps is not None and step in save_steps and rank == 0 and save_dir:
+            for i, trainer in enumerate(trainers):
+                checkpoint_dir = os.path.join(save_dir, f"trainer_{i}", "checkpoints")
+                save_trainer(trainer, checkpoint_dir, f"ae_{step}.pt", norm_factor)
+
+        if (
+            backup_steps is not None
+            and step > 0
+            and step % backup_steps == 0
+            and rank == 0
+            and save_dir
+        ):
+            for i, trainer in enumerate(trainers):
+                save_trainer(trainer, os.path.join(save_dir, f"trainer_{i}"), "ae.pt", norm_factor)
+
+        for trainer in trainers:
+            counters_before = _snapshot_counters(trainer) if distributed else {}
+            with autocast_context:
+                trainer.update(step, act)
+            if distributed:
+                _sync_trainer_state(trainer, counters_before, world_size)
+                if step == 0:
+                    # Data-dependent initialization (e.g. b_dec from the first batch)
+                    # must be identical on every rank
+                    _broadcast_state(trainer.ae)
+
+        if eval_fn is not None and eval_steps is not None and step in eval_steps and rank == 0:
+            eval_fn(step, [raw_copy(trainer.ae, norm_factor) for trainer in trainers])
+
+        if log_steps is not None and step % log_steps == 0 and rank == 0:
+            tokens_per_second = (step + 1) * len(act) * world_size / (time.time() - start_time)
+            print(f"step {step}: {tokens_per_second:,.0f} tokens / second")
+
+    for handle in grad_hooks:
+        handle.remove()
+
+    # Training is over, so every rank can scale its own dictionaries in place
+    for i, trainer in enumerate(trainers):
+        if normalize_activations:
+            trainer.ae.scale_biases(norm_factor)
+        if rank == 0 and save_dir is not None:
+            save_trainer(trainer, os.path.join(save_dir, f"trainer_{i}"))
+
+    if eval_fn is not None and rank == 0:
+        eval_fn(steps, [trainer.ae for trainer in trainers])
+
+    if distributed:
+        dist.barrier()
+
+    return trainers
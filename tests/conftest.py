@@ -0,0 +1,50 @@
+import pytest
+
+WORDS = [f"w{i}" for i in range(100)]
+
+
+@pytest.fixture
+def tiny_tokenizer():
+    """Offline word-level tokenizer over WORDS, with a pad token."""
+    pytest.importorskip("tokenizers")
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    vocab = {"[UNK]": 0, "[PAD]": 1, **{word: i + 2 for i, word in enumerate(WORDS)}}
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="[UNK]", pad_token="[PAD]"
+    )
+
+
+@pytest.fixture
+def tiny_model():
+    """Random 4 layer GPTNeoX, small enough to run on CPU in tests."""
+    t = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    t.manual_seed(0)
+    config = transformers.GPTNeoXConfig(
+        vocab_size=len(WORDS) + 2,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        max_position_embeddings=64,
+    )
+    return transformers.AutoModelForCausalLM.from_config(config).eval()
+
+
+@pytest.fixture
+def texts():
+    """Endless stream of random texts of varying length, so batches need padding."""
+    import random
+
+    rng = random.Random(0)
+
+    def generate():
+        while True:
+            yield " ".join(rng.choices(WORDS, k=rng.randint(3, 20)))
+
+    return generate()
@@ -0,0 +1,149 @@
+import pytest
+
+t = pytest.importorskip("torch")
+
+from adaptive_eval import RunningStat, evaluate_adaptive
+from capture_buffer import CachedActivations, CaptureBuffer
+from early_exit import get_layer, get_mlp
+from transcoder import TopKTranscoder, evaluate_transcoder
+
+CTX_LEN = 16
+EVAL_BATCH = 4
+
+
+class Counting:
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.count += 1
+        return next(self.iterator)
+
+
+def make_buffer(model, tokenizer, data, io: str = "out") -> CaptureBuffer:
+    return CaptureBuffer(
+        data,
+        model,
+        get_mlp(model, 1) if io == "in_and_out" else get_layer(model, 1),
+        d_submodule=32,
+        io=io,
+        n_ctxs=EVAL_BATCH,
+        ctx_len=CTX_LEN,
+        refresh_batch_size=EVAL_BATCH,
+        out_batch_size=EVAL_BATCH * CTX_LEN,
+        tokenizer=tokenizer,
+    )
+
+
+def test_running_stat():
+    stat = RunningStat()
+    values = [1.0, 2.0, 4.0, 7.0]
+    for value in values:
+        stat.update(value)
+    assert stat.mean == pytest.approx(sum(values) / 4)
+    assert stat.variance == pytest.approx(t.tensor(values).var().item())
+
+
+def test_stops_once_intervals_are_tight(tiny_model, tiny_tokenizer, texts):
+    """With a buffer of one eval batch, an early stop also stops activation collection."""
+    data = Counting(texts)
+    buffer = make_buffer(tiny_model, tiny_tokenizer, data)
+
+    def evaluate_fn(dictionary, activations, *args, n_batches=1, **kwargs):
+        x = next(activations)
+        return {"l0": 10.0 + 0.01 * x.mean().item(), "frac_alive": 0.5}
+
+    max_batches = 50
+    results = evaluate_adaptive(
+        TopKTranscoder(32, 64, k=8),
+        buffer,
+        CTX_LEN,
+        EVAL_BATCH,
+        io="out",
+        device="cpu",
+        target_relative_ci_widths={"l0": 0.01},
+        max_batches=max_batches,
+        min_batches=5,
+        evaluate_fn=evaluate_fn,
+    )
+
+    assert results["n_batches"] == 5
+    assert results["confidence_intervals"]["l0"]["relative_width"] <= 0.01
+    # Padding is dropped, so a refill can take a few forwards of EVAL_BATCH contexts
+    assert data.count <= 3 * EVAL_BATCH * results["n_batches"]
+    assert data.count < EVAL_BATCH * max_batches
+
+
+def test_missing_target_metric_raises(tiny_model, tiny_tokenizer, texts):
+    buffer = make_buffer(tiny_model, tiny_tokenizer, texts)
+
+    def evaluate_fn(dictionary, activations, *args, n_batches=1, **kwargs):
+        next(activations)
+        return {"l0": 10.0}
+
+    with pytest.raises(ValueError, match="frac_recovered"):
+        evaluate_adaptive(
+            TopKTranscoder(32, 64, k=8),
+            buffer,
+            CTX_LEN,
+            EVAL_BATCH,
+            io="out",
+            device="cpu",
+            target_relative_ci_widths={"l0": 0.01, "frac_recovered": 0.01},
+            max_batches=10,
+            evaluate_fn=evaluate_fn,
+        )
+
+
+def test_matches_a_full_evaluation_on_the_same_batches(tiny_model, tiny_tokenizer, texts):
+    """Drives a real evaluation, and compares against evaluating the batches in one call."""
+    t.manual_seed(0)
+    cache = CachedActivations(make_buffer(tiny_model, tiny_tokenizer, texts, io="in_and_out"))
+    transcoder = TopKTranscoder(32, 64, k=4)
+
+    results = evaluate_adaptive(
+        transcoder,
+        cache,
+        CTX_LEN,
+        EVAL_BATCH,
+        io="in_and_out",
+        device="cpu",
+        target_relative_ci_widths={"l0": 1e-6, "mse": 1e-6},
+        max_batches=6,
+        min_batches=2,
+        evaluate_fn=evaluate_transcoder,
+    )
+    assert results["n_batches"] == 6
+
+    cache.rewind()
+    expected = evaluate_transcoder(
+        transcoder, cache, CTX_LEN, EVAL_BATCH, io="in_and_out", n_batches=6
+    )
+    for metric in ["l0", "mse", "l2_loss", "frac_variance_explained"]:
+        assert results[metric] == pytest.approx(expected[metric], rel=1e-5)
+    # Features alive on any batch, not the best single batch
+    assert results["frac_alive"] == pytest.approx(expected["frac_alive"])
+    assert results["confidence_intervals"]["mse"]["mean"] == pytest.approx(expected["mse"])
+
+
+def test_cached_activations_replay_without_the_model(tiny_model, tiny_tokenizer, texts):
+    data = Counting(texts)
+    cache = CachedActivations(make_buffer(tiny_model, tiny_tokenizer, data))
+    first = [next(cache) for _ in range(3)]
+    consumed = data.count
+    assert all(batch.device.type == "cpu" for batch in cache.batches)
+
+    # A second pass, e.g. the next dictionary, replays the same batches
+    cache.rewind()
+    for expected in first:
+        assert t.equal(next(cache), expected)
+    assert data.count == consumed
+
+    # Reading past the cached batches collects new ones
+    assert next(cache).shape == first[0].shape
+    assert data.count > consumed
+    assert cache.model is tiny_model
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from artifact_upload import LocalDirBackend, publish_folder
+
+
+class FlakyBackend(LocalDirBackend):
+    """Fails on the commit after `fail_after` successful ones, like a dropped connection."""
+
+    def __init__(self, root: str, fail_after: int):
+        super().__init__(root)
+        self.fail_after = fail_after
+        self.commits = []
+
+    def upload_files(self, files, message):
+        if len(self.commits) == self.fail_after:
+            raise ConnectionError("upload interrupted")
+        super().upload_files(files, message)
+        self.commits.append([path_in_repo for _, path_in_repo in files])
+
+
+def write(path, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+@pytest.fixture
+def sweep(tmp_path):
+    folder = tmp_path / "sweep"
+    for i in range(5):
+        write(str(folder / f"trainer_{i}" / "ae.pt"), f"weights {i}".encode())
+        write(str(folder / f"trainer_{i}" / "config.json"), b"{}")
+    return str(folder)
+
+
+def test_upload_then_rerun_uploads_nothing(sweep, tmp_path):
+    backend = LocalDirBackend(str(tmp_path / "remote"))
+
+    uploaded = publish_folder(sweep, backend, path_in_repo="run")
+    assert len(uploaded) == 10
+    with open(tmp_path / "remote" / "run" / "trainer_3" / "ae.pt", "rb") as f:
+        assert f.read() == b"weights 3"
+
+    assert publish_folder(sweep, backend, path_in_repo="run") == []
+
+
+def test_modified_file_is_reuploaded(sweep, tmp_path):
+    backend = LocalDirBackend(str(tmp_path / "remote"))
+    publish_folder(sweep, backend)
+
+    write(os.path.join(sweep, "trainer_1", "ae.pt"), b"retrained weights")
+    assert publish_folder(sweep, backend) == ["trainer_1/ae.pt"]
+    with open(tmp_path / "remote" / "trainer_1" / "ae.pt", "rb") as f:
+        assert f.read() == b"retrained weights"
+
+
+def test_files_are_batched_into_commits(sweep, tmp_path):
+    backend = FlakyBackend(str(tmp_path / "remote"), fail_after=-1)
+    publish_folder(sweep, backend, files_per_commit=4)
+    assert [len(commit) for commit in backend.commits] == [4, 4, 2]
+
+
+def test_interrupted_upload_resumes(sweep, tmp_path):
+    remote = str(tmp_path / "remote")
+    backend = FlakyBackend(remote, fail_after=1)
+    with pytest.raises(ConnectionError):
+        publish_folder(sweep, backend, files_per_commit=4)
+    first_commit = backend.commits[0]
+
+    # Only the files that were not committed before the failure are uploaded again
+    resumed = FlakyBackend(remote, fail_after=-1)
+    uploaded = publish_folder(sweep, resumed, files_per_commit=4)
+    assert len(uploaded) == 6
+    assert not set(first_commit) & set(uploaded)
+    assert publish_folder(sweep, resumed) == []
@@ -0,0 +1,89 @@
+import math
+
+import pytest
+
+import demo
+import demo_config
+
+WIDTHS = [2**12, 2**14]
+
+
+def plan(calibrate_penalties: bool) -> list[dict]:
+    return demo.plan_sae_training(
+        "EleutherAI/pythia-70m-deduped",
+        3,
+        "cpu",
+        ["standard", "top_k"],
+        1_000_000,
+        [0],
+        WIDTHS,
+        [1e-3],
+        calibrate_penalties=calibrate_penalties,
+    )
+
+
+def test_dry_run_plans_one_trainer_per_target_l0():
+    configs = plan(calibrate_penalties=True)
+    standard = [c for c in configs if c["trainer"] == "StandardTrainer"]
+    assert len(standard) == len(demo_config.TARGET_L0s) * len(WIDTHS)
+    assert all(math.isnan(c["l1_penalty"]) for c in standard)
+
+    # top_k is not calibrated, and the default sweep has a different trainer count
+    top_k = [c for c in configs if c["trainer"] == "TopKTrainer"]
+    assert len(top_k) == len(demo_config.TARGET_L0s) * len(WIDTHS)
+    assert len(plan(calibrate_penalties=False)) != len(configs)
+
+
+def calibrate(monkeypatch, target_l0s: list[int], **kwargs):
+    """Calibrates "standard" with pilots whose L0 is exactly 1.6 / l1_penalty."""
+    t = pytest.importorskip("torch")
+    import calibration
+
+    monkeypatch.setattr(demo_config, "resolve_class", lambda name: name)
+    monkeypatch.setattr(
+        calibration,
+        "run_pilots",
+        lambda configs, *args: [1.6 / c["l1_penalty"] for c in configs],
+    )
+    data = iter([t.randn(8, 4) for _ in range(3)])
+    penalties, report = calibration.calibrate_sparsity_penalties(
+        data,
+        ["standard"],
+        4,
+        [16],
+        "EleutherAI/pythia-70m-deduped",
+        "cpu",
+        3,
+        "resid_post_layer_3",
+        steps=1000,
+        learning_rate=1e-3,
+        seed=0,
+        target_l0s=target_l0s,
+        pilot_steps=10,
+        n_cache_batches=2,
+        n_eval_batches=1,
+        **kwargs,
+    )
+    return penalties[16].standard, report
+
+
+def test_bisection_inside_the_default_bracket(monkeypatch):
+    penalties, report = calibrate(monkeypatch, [80, 160], n_rounds=20)
+    assert penalties == pytest.approx([0.02, 0.01], rel=1e-3)
+    assert [b["status"] for b in report["brackets"]] == ["inside", "inside"]
+
+
+def test_bracket_is_widened_when_the_target_is_outside(monkeypatch):
+    # Needs a penalty of 0.0016, below the default bracket starting at 0.012 / 4
+    penalties, report = calibrate(monkeypatch, [1000], n_rounds=20)
+    assert penalties == pytest.approx([0.0016], rel=1e-3)
+    assert report["brackets"][0]["status"] == "expanded"
+
+
+def test_unreachable_target_is_reported(monkeypatch):
+    penalties, report = calibrate(
+        monkeypatch, [1000], n_rounds=20, max_bracket_expansions=0
+    )
+    assert report["brackets"][0]["status"] == "unreachable"
+    assert penalties == pytest.approx([0.012 / 4])
+    assert report["rounds"] == []
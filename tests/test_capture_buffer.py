@@ -0,0 +1,134 @@
+import itertools
+
+import pytest
+
+t = pytest.importorskip("torch")
+
+from capture_buffer import CaptureBuffer
+from early_exit import get_layer
+
+LAYER = 1
+CTX_LEN = 16
+N_CTXS = 4
+REFRESH_BATCH = 4
+SINK_POSITIONS = 2
+
+
+class Counting:
+    def __init__(self, texts):
+        self.iterator = iter(texts)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        text = next(self.iterator)
+        self.count += 1
+        return text
+
+
+def make_buffer(model, tokenizer, texts, sink_positions: int = SINK_POSITIONS) -> CaptureBuffer:
+    return CaptureBuffer(
+        Counting(texts),
+        model,
+        get_layer(model, LAYER),
+        d_submodule=32,
+        n_ctxs=N_CTXS,
+        ctx_len=CTX_LEN,
+        refresh_batch_size=REFRESH_BATCH,
+        out_batch_size=CTX_LEN,
+        tokenizer=tokenizer,
+        sink_positions=sink_positions,
+    )
+
+
+def reference_rows(model, tokenizer, texts, sink_positions: int):
+    """
+    Layer outputs at the real positions after the first sink_positions real tokens of
+    every context, from a full forward. Returns (rows in order, positions seen, dropped).
+    """
+    rows = []
+    total = 0
+    for start in range(0, len(texts), REFRESH_BATCH):
+        tokens = tokenizer(
+            texts[start : start + REFRESH_BATCH],
+            return_tensors="pt",
+            max_length=CTX_LEN,
+            padding=True,
+            truncation=True,
+        )
+        with t.no_grad():
+            hidden = model(**tokens, output_hidden_states=True).hidden_states[LAYER + 1]
+        total += tokens["attention_mask"].numel()
+        for i, mask in enumerate(tokens["attention_mask"]):
+            real = mask.nonzero().squeeze(-1)
+            rows.append(hidden[i, real[sink_positions:]])
+    rows = t.cat(rows)
+    return rows, total, total - len(rows)
+
+
+def test_keep_mask_skips_padding_and_sinks_on_either_side(tiny_model, tiny_tokenizer):
+    buffer = make_buffer(tiny_model, tiny_tokenizer, [])
+    attention_mask = t.tensor(
+        [
+            [1, 1, 1, 1, 0, 0],  # right padding
+            [0, 0, 1, 1, 1, 1],  # left padding
+            [0, 0, 0, 0, 1, 1],  # only sink positions
+        ]
+    )
+    expected = t.tensor(
+        [
+            [0, 0, 1, 1, 0, 0],
+            [0, 0, 0, 0, 1, 1],
+            [0, 0, 0, 0, 0, 0],
+        ],
+        dtype=t.bool,
+    )
+    assert t.equal(buffer.keep_mask(attention_mask), expected)
+
+
+@pytest.mark.parametrize("padding_side", ["right", "left"])
+@pytest.mark.parametrize("sink_positions", [0, SINK_POSITIONS])
+def test_buffer_holds_exactly_the_kept_positions(
+    tiny_model, tiny_tokenizer, texts, padding_side, sink_positions
+):
+    tiny_tokenizer.padding_side = padding_side
+    data = list(itertools.islice(texts, 64))
+    buffer = make_buffer(tiny_model, tiny_tokenizer, data, sink_positions)
+    buffer.refresh()
+
+    expected, total, dropped = reference_rows(
+        tiny_model, tiny_tokenizer, data[: buffer.data.count], sink_positions
+    )
+    size = N_CTXS * CTX_LEN
+    assert len(expected) >= size
+    # Gathered in order, without padded or sink positions
+    assert t.allclose(buffer.activations, expected[:size], atol=1e-5)
+    assert buffer.total_positions == total
+    assert buffer.dropped_positions == dropped
+    assert buffer.dropped_fraction == pytest.approx(dropped / total)
+
+
+def test_refresh_keeps_unread_rows_first(tiny_model, tiny_tokenizer, texts):
+    data = list(itertools.islice(texts, 64))
+    buffer = make_buffer(tiny_model, tiny_tokenizer, data)
+    buffer.refresh()
+    first_refresh = buffer.data.count
+
+    # Read over half of the buffer, the next refresh then has to compact the rest
+    for _ in range(N_CTXS // 2 + 1):
+        next(buffer)
+    unread = buffer.activations[~buffer.read].clone()
+    buffer.refresh()
+
+    # Unread rows first, in order, then the kept positions of the texts read since
+    expected, _, _ = reference_rows(
+        tiny_model, tiny_tokenizer, data[first_refresh : buffer.data.count], SINK_POSITIONS
+    )
+    assert t.equal(buffer.activations[: len(unread)], unread)
+    assert t.allclose(
+        buffer.activations[len(unread) :], expected[: N_CTXS * CTX_LEN - len(unread)], atol=1e-5
+    )
+    assert len(buffer.activations) == N_CTXS * CTX_LEN
+    assert not buffer.read.any()
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+t = pytest.importorskip("torch")
+
+import sae_training
+from cpu_pool_training import train_saes_cpu_pool
+from test_sae_training import D, DICT_SIZE, NORM_STEPS, TinyTrainer
+
+STEPS = 12
+SAVE_STEPS = [0, 5]
+NUM_CONFIGS = 3
+
+
+def make_configs():
+    return [
+        {
+            "trainer": TinyTrainer,
+            "steps": STEPS,
+            "activation_dim": D,
+            "dict_size": DICT_SIZE,
+            "seed": seed,
+            "device": "cpu",
+        }
+        for seed in range(NUM_CONFIGS)
+    ]
+
+
+def make_batches() -> t.Tensor:
+    g = t.Generator().manual_seed(0)
+    return 3 * t.randn(NORM_STEPS + STEPS, 16, D, generator=g)
+
+
+def test_pool_matches_single_process(tmp_path):
+    sae_training.train_saes(
+        iter(make_batches()),
+        make_configs(),
+        steps=STEPS,
+        save_dir=str(tmp_path / "single"),
+        save_steps=SAVE_STEPS,
+        normalize_activations=True,
+    )
+    # Three configs over two workers, so worker 0 trains two of them
+    train_saes_cpu_pool(
+        iter(make_batches()),
+        make_configs(),
+        steps=STEPS,
+        num_workers=2,
+        save_dir=str(tmp_path / "pool"),
+        save_steps=SAVE_STEPS,
+        normalize_activations=True,
+        threads_per_worker=1,
+        producer_threads=1,
+        pin_cores=False,
+    )
+
+    filenames = ["ae.pt"] + [f"checkpoints/ae_{step}.pt" for step in SAVE_STEPS]
+    for i in range(NUM_CONFIGS):
+        single_dir = tmp_path / "single" / f"trainer_{i}"
+        pool_dir = tmp_path / "pool" / f"trainer_{i}"
+        for filename in filenames:
+            expected = t.load(single_dir / filename)
+            saved = t.load(pool_dir / filename)
+            assert saved.keys() == expected.keys()
+            for name in expected:
+                t.testing.assert_close(saved[name], expected[name], rtol=1e-4, atol=1e-5)
+
+        expected_config = json.loads((single_dir / "config.json").read_text())
+        pool_config = json.loads((pool_dir / "config.json").read_text())
+        assert pool_config["trainer"] == pytest.approx(expected_config["trainer"])
@@ -0,0 +1,126 @@
+import pytest
+
+t = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from early_exit import (
+    collect_activations,
+    find_decoder_layers,
+    get_layer,
+    get_mlp,
+    load_truncated_model,
+    truncate_model,
+)
+
+NUM_LAYERS = 4
+COMMON = dict(
+    vocab_size=128,
+    hidden_size=32,
+    intermediate_size=64,
+    num_hidden_layers=NUM_LAYERS,
+    num_attention_heads=4,
+    max_position_embeddings=64,
+)
+
+# Tiny random configs of architectures with differently named layer lists
+# (gpt_neox.layers vs model.layers) and with / without tied embeddings
+CONFIGS = {
+    "gpt_neox": lambda: transformers.GPTNeoXConfig(**COMMON, tie_word_embeddings=False),
+    "qwen2": lambda: transformers.Qwen2Config(
+        **COMMON, num_key_value_heads=2, tie_word_embeddings=False
+    ),
+    "gemma2": lambda: transformers.Gemma2Config(
+        **COMMON, num_key_value_heads=2, head_dim=8, tie_word_embeddings=True
+    ),
+}
+
+
+def make_model(name: str):
+    t.manual_seed(0)
+    config = CONFIGS[name]()
+    config._attn_implementation = "eager"
+    return transformers.AutoModelForCausalLM.from_config(config).eval()
+
+
+def make_inputs():
+    g = t.Generator().manual_seed(0)
+    input_ids = t.randint(0, 128, (2, 10), generator=g)
+    attention_mask = t.ones_like(input_ids)
+    attention_mask[1, :3] = 0  # left padding
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+def full_hidden_states(model, inputs):
+    with t.no_grad():
+        return model(**inputs, output_hidden_states=True).hidden_states
+
+
+@pytest.mark.parametrize("name", CONFIGS)
+def test_finds_decoder_layers(name):
+    model = make_model(name)
+    _, layers = find_decoder_layers(model)
+    assert len(layers) == NUM_LAYERS
+    assert get_layer(model, 0) is layers[0]
+    assert get_mlp(model, 1) is layers[1].mlp
+
+
+# hidden_states[-1] has the final norm applied, so only compare layers before the last
+@pytest.mark.parametrize("name", CONFIGS)
+@pytest.mark.parametrize("layer", range(NUM_LAYERS - 1))
+def test_early_exit_matches_full_forward(name, layer):
+    model = make_model(name)
+    inputs = make_inputs()
+    expected = full_hidden_states(model, inputs)
+
+    with t.no_grad():
+        out, in_and_out = (
+            collect_activations(model, [get_layer(model, layer)], inputs, io=io)[0]
+            for io in ["out", "in_and_out"]
+        )
+
+    t.testing.assert_close(out, expected[layer + 1])
+    t.testing.assert_close(in_and_out[:, :, 0], expected[layer])
+    t.testing.assert_close(in_and_out[:, :, 1], expected[layer + 1])
+
+
+@pytest.mark.parametrize("name", CONFIGS)
+def test_early_exit_multiple_submodules(name):
+    model = make_model(name)
+    inputs = make_inputs()
+    expected = full_hidden_states(model, inputs)
+
+    with t.no_grad():
+        acts = collect_activations(
+            model, [get_layer(model, 2), get_layer(model, 0)], inputs
+        )
+
+    t.testing.assert_close(acts[0], expected[3])
+    t.testing.assert_close(acts[1], expected[1])
+
+
+@pytest.mark.parametrize("name", CONFIGS)
+def test_truncated_model_matches_full_forward(name, tmp_path):
+    model = make_model(name)
+    inputs = make_inputs()
+    expected = full_hidden_states(model, inputs)
+    input_embeddings = model.get_input_embeddings().weight.clone()
+    model.save_pretrained(tmp_path)
+
+    layer = 1
+    truncated = truncate_model(make_model(name), layer)
+    loaded = load_truncated_model(str(tmp_path), layer, t.float32, device_map=None)
+
+    for m in [truncated, loaded]:
+        m.eval()
+        assert len(find_decoder_layers(m)[1]) == layer + 1
+        assert m.config.num_hidden_layers == layer + 1
+        assert isinstance(m.get_output_embeddings(), (t.nn.Identity, type(None)))
+        # Tied input embeddings must survive dropping the unembedding
+        t.testing.assert_close(m.get_input_embeddings().weight, input_embeddings)
+
+        with t.no_grad():
+            act = collect_activations(m, [get_layer(m, layer)], inputs)[0]
+        # The reloaded model uses the default (sdpa) attention, which differs from eager
+        # only at padded positions. Those are never stored, so compare real tokens.
+        real = inputs["attention_mask"].bool()
+        t.testing.assert_close(act[real], expected[layer + 1][real])
@@ -0,0 +1,165 @@
+import itertools
+import json
+
+import pytest
+
+from mixed_dataset import TokenRatioMixer, pack_texts
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def endless(word: str, lengths: list[int]):
+    """Factory of an endless local source cycling through samples of the given lengths."""
+
+    def make_iter():
+        for length in itertools.cycle(lengths):
+            yield " ".join([word] * length)
+
+    return make_iter
+
+
+def test_mix_holds_token_ratio():
+    # Chat samples are 10x longer than pretrain samples, so a sample ratio would be far off
+    mixer = TokenRatioMixer(
+        sources={"pretrain": endless("p", [1]), "chat": endless("c", [10])},
+        fractions={"pretrain": 0.9, "chat": 0.1},
+        count_tokens=count_words,
+    )
+    texts = list(itertools.islice(mixer, 20_000))
+    mixer.close()
+
+    tokens = {"pretrain": 0, "chat": 0}
+    for text in texts:
+        tokens["pretrain" if text.startswith("p") else "chat"] += count_words(text)
+    total = sum(tokens.values())
+
+    assert tokens["pretrain"] / total == pytest.approx(0.9, abs=1e-4)
+    assert mixer.token_fractions()["pretrain"] == pytest.approx(tokens["pretrain"] / total)
+
+    # The mix already holds early in the stream, not only on average
+    seen = 0
+    for text in texts[:1000]:
+        seen += count_words(text) if text.startswith("c") else 0
+    assert seen / sum(map(count_words, texts[:1000])) == pytest.approx(0.1, abs=0.02)
+
+
+def test_exact_mix_with_unit_samples():
+    mixer = TokenRatioMixer(
+        sources={"a": endless("a", [1]), "b": endless("b", [1])},
+        fractions={"a": 0.9, "b": 0.1},
+        count_tokens=count_words,
+    )
+    for _ in itertools.islice(mixer, 100_000):
+        pass
+    mixer.close()
+    assert mixer.token_fractions()["a"] == pytest.approx(0.9, abs=1e-6)
+
+
+def test_stops_when_any_source_is_exhausted():
+    mixer = TokenRatioMixer(
+        sources={"long": endless("l", [5]), "short": lambda: ["s s", "s s s"]},
+        fractions={"long": 0.5, "short": 0.5},
+        count_tokens=count_words,
+    )
+    texts = list(mixer)
+    assert [t for t in texts if t.startswith("s")] == ["s s", "s s s"]
+    assert mixer.finished
+    assert next(mixer, None) is None
+
+
+def test_zero_fraction_sources_are_never_read():
+    def never():
+        raise AssertionError("source with a zero fraction was read")
+
+    mixer = TokenRatioMixer(
+        sources={"a": endless("a", [2]), "b": never},
+        fractions={"a": 1.0, "b": 0.0},
+        count_tokens=count_words,
+    )
+    assert list(itertools.islice(mixer, 10)) == ["a a"] * 10
+    mixer.close()
+
+
+def test_source_errors_reach_the_consumer():
+    def failing():
+        yield "f"
+        raise ConnectionError("stream dropped")
+
+    mixer = TokenRatioMixer(
+        sources={"ok": endless("o", [1]), "failing": failing},
+        fractions={"ok": 0.5, "failing": 0.5},
+        count_tokens=count_words,
+    )
+    with pytest.raises(ConnectionError, match="stream dropped"):
+        for _ in itertools.islice(mixer, 100):
+            pass
+    mixer.close()
+
+
+def test_invalid_fractions():
+    with pytest.raises(ValueError):
+        TokenRatioMixer({"a": list}, {"b": 1.0}, count_words)
+    with pytest.raises(ValueError):
+        TokenRatioMixer({"a": list}, {"a": -1.0}, count_words)
+
+
+def test_pack_texts():
+    assert list(pack_texts(["ab", "c", "defg", "h"], min_chars=3, separator="|")) == [
+        "ab|c",
+        "defg",
+    ]
+
+
+def test_ranks_stream_disjoint_parts(tmp_path):
+    pytest.importorskip("datasets")
+    from mixed_dataset import load_stream
+
+    for i in range(4):
+        rows = [json.dumps({"text": f"doc {i}-{j}"}) for j in range(5)]
+        (tmp_path / f"part_{i}.jsonl").write_text("\n".join(rows))
+
+    everything = [row["text"] for row in load_stream(str(tmp_path))]
+    ranks = [
+        [row["text"] for row in load_stream(str(tmp_path), rank=rank, world_size=2)]
+        for rank in range(2)
+    ]
+    assert len(everything) == 20
+    assert not set(ranks[0]) & set(ranks[1])
+    assert sorted(ranks[0] + ranks[1]) == sorted(everything)
+
+
+def test_prefetch_threads_do_not_share_the_tokenizer(tmp_path, tiny_tokenizer):
+    pytest.importorskip("datasets")
+    from mixed_dataset import parallel_mixed_dataset_to_generator
+
+    for name in ["pretrain", "chat"]:
+        (tmp_path / name).mkdir()
+    words = [f"w{i}" for i in range(100)]
+    pretrain_rows = [{"text": " ".join(words[: 5 + i % 40])} for i in range(200)]
+    chat_rows = [
+        {"conversation": [{"role": "user", "content": " ".join(words[: 3 + i % 20])}]}
+        for i in range(200)
+    ]
+    for name, rows in [("pretrain", pretrain_rows), ("chat", chat_rows)]:
+        (tmp_path / name / "data.jsonl").write_text("\n".join(map(json.dumps, rows)))
+    tiny_tokenizer.chat_template = "{% for m in messages %}{{ m['content'] }} {% endfor %}"
+
+    mixer = parallel_mixed_dataset_to_generator(
+        tiny_tokenizer,
+        pretrain_dataset=str(tmp_path / "pretrain"),
+        chat_dataset=str(tmp_path / "chat"),
+        pretrain_frac=0.5,
+        queue_size=4,
+    )
+    seen = []
+    for text in itertools.islice(mixer, 150):
+        # The caller keeps tokenizing with truncation while the prefetch threads count
+        tiny_tokenizer(text, truncation=True, max_length=2)
+        seen.append(text)
+    mixer.close()
+
+    counted = sum(s.tokens for s in mixer.stats.values())
+    lengths = [len(tiny_tokenizer(text, add_special_tokens=False)["input_ids"]) for text in seen]
+    assert counted == sum(lengths)
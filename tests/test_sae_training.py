@@ -0,0 +1,162 @@
+import os
+import socket
+
+import pytest
+
+t = pytest.importorskip("torch")
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import sae_training
+
+WORLD_SIZE = 2
+D = 8
+DICT_SIZE = 16
+LOCAL_BATCH = 8
+NORM_STEPS = 100
+STEPS = 12
+
+
+class TinyAE(t.nn.Module):
+    def __init__(self, activation_dim: int, dict_size: int):
+        super().__init__()
+        self.encoder = t.nn.Linear(activation_dim, dict_size)
+        self.decoder = t.nn.Linear(dict_size, activation_dim)
+        # Like the BatchTopK threshold: an EMA of the smallest positive activation
+        self.register_buffer("threshold", t.tensor(0.0))
+
+    def forward(self, x):
+        return self.decoder(t.relu(self.encoder(x)))
+
+    @t.no_grad()
+    def scale_biases(self, scale: float):
+        self.encoder.bias.mul_(scale)
+        self.decoder.bias.mul_(scale)
+        self.threshold.mul_(scale)
+
+
+class TinyTrainer:
+    """Stand-in for a dictionary_learning trainer, with the state train_saes syncs."""
+
+    def __init__(self, steps: int, activation_dim: int, dict_size: int, seed: int, device: str):
+        t.manual_seed(seed)
+        self.ae = TinyAE(activation_dim, dict_size).to(device)
+        self.device = device
+        self.optimizer = t.optim.Adam(self.ae.parameters(), lr=1e-2)
+        self.num_tokens_since_fired = t.zeros(dict_size, dtype=t.long)
+
+    def update(self, step: int, x: t.Tensor):
+        f = t.relu(self.ae.encoder(x))
+        loss = (self.ae.decoder(f) - x).pow(2).sum(dim=-1).mean()
+        loss.backward()
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+
+        with t.no_grad():
+            self.ae.threshold.mul_(0.9).add_(0.1 * f[f > 0].min())
+            self.num_tokens_since_fired += x.size(0)
+            self.num_tokens_since_fired[(f > 0).any(dim=0)] = 0
+
+    @property
+    def config(self):
+        return {}
+
+
+class PAnnealTrainer(TinyTrainer):
+    """Same name as the dictionary_learning trainer whose local-batch state isn't synced."""
+
+
+def make_configs():
+    return [
+        {
+            "trainer": TinyTrainer,
+            "steps": STEPS,
+            "activation_dim": D,
+            "dict_size": DICT_SIZE,
+            "seed": seed,
+            "device": "cpu",
+        }
+        for seed in range(2)
+    ]
+
+
+def make_batches() -> t.Tensor:
+    """(steps, global batch, d), with a few features that fire only in rank 1's half."""
+    g = t.Generator().manual_seed(0)
+    batches = t.randn(NORM_STEPS + STEPS, WORLD_SIZE * LOCAL_BATCH, D, generator=g)
+    batches[:, LOCAL_BATCH:] *= 3
+    return batches
+
+
+def train(data, save_dir=None):
+    return sae_training.train_saes(
+        iter(data),
+        make_configs(),
+        steps=STEPS,
+        save_dir=save_dir,
+        save_steps=[2, 5],
+        normalize_activations=True,
+        eval_steps=[3],
+        eval_fn=_eval_fn,
+    )
+
+
+def _eval_fn(step, dictionaries):
+    for dictionary in dictionaries:
+        dictionary(t.zeros(1, D))
+
+
+def state(trainer) -> dict[str, t.Tensor]:
+    return {
+        **trainer.ae.state_dict(),
+        "num_tokens_since_fired": trainer.num_tokens_since_fired,
+    }
+
+
+def _worker(rank: int, port: int, out_dir: str):
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+        RANK=str(rank),
+        WORLD_SIZE=str(WORLD_SIZE),
+        LOCAL_RANK=str(rank),
+    )
+    sae_training.init_distributed(backend="gloo")
+    try:
+        batches = make_batches()
+        local = batches[:, rank * LOCAL_BATCH : (rank + 1) * LOCAL_BATCH]
+        save_dir = os.path.join(out_dir, "saes") if rank == 0 else None
+        trainers = train(local, save_dir)
+        t.save([state(trainer) for trainer in trainers], os.path.join(out_dir, f"rank_{rank}.pt"))
+
+        with pytest.raises(ValueError, match="PAnnealTrainer"):
+            config = {**make_configs()[0], "trainer": PAnnealTrainer}
+            sae_training.train_saes(iter(local), [config], steps=1)
+    finally:
+        dist.destroy_process_group()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_data_parallel_matches_single_process(tmp_path):
+    mp.spawn(_worker, args=(free_port(), str(tmp_path)), nprocs=WORLD_SIZE, join=True)
+    ranks = [t.load(tmp_path / f"rank_{rank}.pt") for rank in range(WORLD_SIZE)]
+
+    # Replicas are bit-identical, including after rank 0 saved checkpoints and evaluated
+    for trainer_0, trainer_1 in zip(*ranks):
+        for name in trainer_0:
+            assert t.equal(trainer_0[name], trainer_1[name]), name
+
+    # And match training on the concatenated batches in a single process
+    single = [state(trainer) for trainer in train(make_batches())]
+    for distributed, expected in zip(ranks[0], single):
+        for name in expected:
+            t.testing.assert_close(distributed[name], expected[name], rtol=1e-4, atol=1e-5)
+
+    for i in range(len(single)):
+        for filename in ["ae.pt", "checkpoints/ae_2.pt", "checkpoints/ae_5.pt"]:
+            assert (tmp_path / "saes" / f"trainer_{i}" / filename).exists()
@@ -0,0 +1,138 @@
+import itertools
+import json
+import random
+
+import pytest
+
+from token_census import available_tokens, steps_from_manifest, token_census
+
+SETTINGS = {"generator": "parallel_mixed_dataset_to_generator", "pretrain_frac": 0.9}
+
+
+def write_manifest(tmp_path, pretrain: int, chat: int, exhausted=("chat",), **overrides):
+    manifest = {
+        "tokenizer": "tok",
+        "ctx_len": 8,
+        "target_tokens": 1_000,
+        "fractions": {"pretrain": 0.9, "chat": 0.1},
+        "settings": SETTINGS,
+        "sources": {
+            "pretrain": {"usable_tokens": pretrain, "exhausted": "pretrain" in exhausted},
+            "chat": {"usable_tokens": chat, "exhausted": "chat" in exhausted},
+        },
+        "total": {"usable_tokens": pretrain + chat},
+        **overrides,
+    }
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps(manifest))
+    return str(path)
+
+
+def steps(path, num_tokens, **kwargs):
+    return steps_from_manifest(path, num_tokens, 10, 8, "tok", SETTINGS, **kwargs)
+
+
+def test_availability_is_limited_by_the_first_source_to_run_out(tmp_path):
+    # 10k total tokens, but the mixer stops when the 50 chat tokens are used up
+    path = write_manifest(tmp_path, pretrain=9_950, chat=50)
+    with open(path) as f:
+        assert available_tokens(json.load(f)) == (500, "chat")
+
+    assert steps(path, 500) == 50
+    with pytest.raises(RuntimeError, match="'chat' runs out"):
+        steps(path, 1_000)
+    assert steps(path, 1_000, allow_fewer_steps=True) == 50
+
+
+def test_census_stopped_before_the_limiting_source_ran_out(tmp_path):
+    path = write_manifest(tmp_path, pretrain=900, chat=5_000, exhausted=("chat",))
+    with pytest.raises(ValueError, match="larger target"):
+        steps(path, 2_000, allow_fewer_steps=True)
+
+
+def test_manifest_must_describe_the_run(tmp_path):
+    path = write_manifest(tmp_path, pretrain=9_000, chat=1_000)
+    assert steps(path, 1_000) == 100
+
+    with pytest.raises(ValueError, match="tokenizer"):
+        steps_from_manifest(path, 1_000, 10, 8, "other", SETTINGS)
+    with pytest.raises(ValueError, match="ctx_len"):
+        steps_from_manifest(path, 1_000, 10, 16, "tok", SETTINGS)
+    with pytest.raises(ValueError, match="settings"):
+        steps_from_manifest(path, 1_000, 10, 8, "tok", {**SETTINGS, "pretrain_frac": 0.5})
+
+
+def word_texts(seed: int):
+    """Factory of an endless deterministic source of texts of 1 to 20 words."""
+
+    def make_iter():
+        rng = random.Random(seed)
+        while True:
+            yield " ".join(f"w{rng.randrange(100)}" for _ in range(rng.randint(1, 20)))
+
+    return make_iter
+
+
+def test_census_counts_match_direct_tokenization(tmp_path, tiny_tokenizer):
+    tiny_tokenizer.save_pretrained(tmp_path / "tokenizer")
+    ctx_len, batch_size, num_workers = 8, 4, 2
+    finite = list(itertools.islice(word_texts(0)(), 10))
+    sources = {"finite": lambda: iter(finite), "endless": word_texts(1)}
+    fractions = {"finite": 0.25, "endless": 0.75}
+    target_tokens = 400
+
+    manifest = token_census(
+        sources,
+        str(tmp_path / "tokenizer"),
+        ctx_len,
+        target_tokens=target_tokens,
+        fractions=fractions,
+        settings=SETTINGS,
+        batch_size=batch_size,
+        batches_per_shard=2,
+        num_workers=num_workers,
+    )
+
+    def expected_counts(texts):
+        ids = tiny_tokenizer(texts, add_special_tokens=False)["input_ids"]
+        lengths = [len(x) for x in ids]
+        usable = sum(min(length, ctx_len) for length in lengths)
+        return {
+            "samples": len(texts),
+            "tokens": sum(lengths),
+            "usable_tokens": usable,
+            "packing_yield": usable / sum(lengths),
+        }
+
+    def check(source, texts):
+        expected = expected_counts(texts)
+        assert {key: source[key] for key in expected} == pytest.approx(expected)
+        shard_size = 2 * batch_size
+        assert [shard["index"] for shard in source["shards"]] == list(
+            range(len(source["shards"]))
+        )
+        for shard in source["shards"]:
+            i = shard["index"]
+            shard_expected = expected_counts(texts[i * shard_size : (i + 1) * shard_size])
+            assert {key: shard[key] for key in shard_expected} == pytest.approx(
+                shard_expected
+            )
+
+    # The finite source runs out before reaching its 100 usable tokens
+    finite_counts = manifest["sources"]["finite"]
+    assert finite_counts["exhausted"]
+    assert finite_counts["usable_tokens"] < target_tokens * fractions["finite"]
+    check(finite_counts, finite)
+    assert len(finite_counts["shards"]) == 2
+
+    # The endless source stops once it has its 300 usable tokens, up to the batches in flight
+    endless_counts = manifest["sources"]["endless"]
+    target = target_tokens * fractions["endless"]
+    assert not endless_counts["exhausted"]
+    assert endless_counts["usable_tokens"] >= target
+    assert endless_counts["usable_tokens"] < target + (2 * num_workers + 1) * batch_size * ctx_len
+    check(endless_counts, list(itertools.islice(word_texts(1)(), endless_counts["samples"])))
+
+    assert manifest["shard_size"] == 2 * batch_size
+    assert manifest["total"]["tokens"] == finite_counts["tokens"] + endless_counts["tokens"]
+    assert manifest["fractions"] == fractions
@@ -0,0 +1,145 @@
+import pytest
+
+t = pytest.importorskip("torch")
+
+import demo_config
+from capture_buffer import CaptureBuffer
+from early_exit import get_mlp
+from sae_training import get_norm_factor, normalize, train_saes
+from transcoder import (
+    TopKTranscoder,
+    TranscoderTopKTrainer,
+    evaluate_transcoder,
+    load_transcoder,
+)
+
+D = 16
+
+
+def sparse_pairs(n_batches: int, batch_size: int = 256, seed: int = 0):
+    """
+    Pairs generated from shared sparse codes, with output norms 10x the input norms.
+    The dictionaries are the same for every seed, only the codes differ.
+    """
+    g = t.Generator().manual_seed(0)
+    dict_in = t.randn(64, D, generator=g)
+    dict_out = 10 * t.randn(64, D, generator=g)
+    g = t.Generator().manual_seed(seed)
+    for _ in range(n_batches):
+        codes = t.rand(batch_size, 64, generator=g) * (t.rand(batch_size, 64, generator=g) < 0.05)
+        yield t.stack([codes @ dict_in, codes @ dict_out], dim=1)
+
+
+def make_trainer(steps: int, lr: float = 1e-3) -> TranscoderTopKTrainer:
+    return TranscoderTopKTrainer(
+        steps=steps,
+        activation_dim=D,
+        dict_size=128,
+        k=8,
+        layer=0,
+        lm_name="test",
+        lr=lr,
+        warmup_steps=10,
+        seed=0,
+        device="cpu",
+    )
+
+
+def test_norm_factor_is_per_side_for_pairs():
+    batches = list(sparse_pairs(10))
+    norm_factor = get_norm_factor(iter(batches), steps=10)
+    assert isinstance(norm_factor, list) and len(norm_factor) == 2
+    assert norm_factor[1] > 5 * norm_factor[0]
+
+    normalized = t.cat([normalize(x, norm_factor) for x in batches])
+    mean_squared_norms = normalized.pow(2).sum(dim=-1).mean(dim=0)
+    t.testing.assert_close(mean_squared_norms, t.ones(2), rtol=1e-4, atol=1e-4)
+
+    plain = [x[:, 0] for x in batches]
+    assert isinstance(get_norm_factor(iter(plain), steps=10), float)
+
+
+def test_trainer_reconstructs_output_not_input():
+    steps = 600
+    norm_factor = get_norm_factor(sparse_pairs(10, seed=1), steps=10)
+    trainer = make_trainer(steps, lr=3e-3)
+    for step, x in enumerate(sparse_pairs(steps)):
+        trainer.update(step, normalize(x, norm_factor))
+
+    x = normalize(next(sparse_pairs(1, seed=2)), norm_factor)
+    results = evaluate_transcoder(trainer.ae, iter([x]), 1, 1)
+    assert results["frac_variance_explained"] > 0.5
+    assert results["l0"] <= 8
+
+    # The prediction matches the output far better than the input
+    y_hat = trainer.ae(x[:, 0])
+    assert (y_hat - x[:, 1]).pow(2).mean() < 0.5 * (y_hat - x[:, 0]).pow(2).mean()
+
+
+def test_scale_biases_converts_to_raw_activations():
+    norm_factor = [0.5, 7.0]
+    ae = make_trainer(1).ae
+    with t.no_grad():
+        ae.encoder.bias.normal_()
+        ae.b_dec.normal_()
+    x_in = next(sparse_pairs(1))[:, 0]
+
+    expected = ae(x_in / norm_factor[0]) * norm_factor[1]
+    ae.scale_biases(norm_factor)
+    t.testing.assert_close(ae(x_in), expected, rtol=1e-4, atol=1e-4)
+
+    ae.scale_biases([1 / f for f in norm_factor])
+    t.testing.assert_close(ae(x_in / norm_factor[0]) * norm_factor[1], expected, rtol=1e-4, atol=1e-4)
+
+
+def test_transcoder_end_to_end(tiny_model, tiny_tokenizer, texts, tmp_path):
+    """The --transcoder path of demo.py: paired MLP capture, training, save, load, eval."""
+    layer = 1
+
+    def make_buffer():
+        return CaptureBuffer(
+            texts,
+            tiny_model,
+            get_mlp(tiny_model, layer),
+            d_submodule=32,
+            io="in_and_out",
+            n_ctxs=64,
+            ctx_len=16,
+            refresh_batch_size=16,
+            out_batch_size=128,
+            tokenizer=tiny_tokenizer,
+        )
+
+    configs = demo_config.get_trainer_configs(
+        [demo_config.TrainerType.TRANSCODER_TOP_K.value],
+        learning_rates=[1e-3],
+        seeds=[0],
+        activation_dim=32,
+        # At least as large as the largest k in TARGET_L0s
+        dict_sizes=[256],
+        model_name="tiny",
+        device="cpu",
+        layer=layer,
+        submodule_name=f"mlp_layer_{layer}",
+        steps=200,
+        warmup_steps=5,
+    )
+    assert all(config["trainer"] is TranscoderTopKTrainer for config in configs)
+
+    buffer = make_buffer()
+    assert next(buffer).shape == (128, 2, 32)
+    train_saes(
+        buffer,
+        configs,
+        steps=200,
+        save_dir=str(tmp_path),
+        normalize_activations=True,
+    )
+
+    for i, config in enumerate(configs):
+        transcoder, saved_config = load_transcoder(str(tmp_path / f"trainer_{i}"), "cpu")
+        assert isinstance(transcoder, TopKTranscoder)
+        assert len(saved_config["trainer"]["norm_factor"]) == 2
+        results = evaluate_transcoder(transcoder, make_buffer(), 16, 8, n_batches=2)
+        assert results["l0"] <= config["k"]
+        assert results["frac_variance_explained"] > 0.5
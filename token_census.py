@@ -0,0 +1,280 @@
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Iterable, Optional
+
+# Set in each worker process by _init_worker
+_tokenizer = None
+
+
+def _init_worker(tokenizer_name: str):
+    global _tokenizer
+    from transformers import AutoTokenizer
+
+    _tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def _count_batch(texts: list[str], ctx_len: int) -> dict[str, int]:
+    ids = _tokenizer(texts, add_special_tokens=False, return_attention_mask=False)[
+        "input_ids"
+    ]
+    lengths = [len(x) for x in ids]
+    return {
+        "samples": len(lengths),
+        "tokens": sum(lengths),
+        # Tokens that survive truncation to ctx_len, i.e. what the activation buffer sees
+        "usable_tokens": sum(min(length, ctx_len) for length in lengths),
+    }
+
+
+def _add_counts(total: dict[str, int], counts: dict[str, int]) -> None:
+    for key, value in counts.items():
+        total[key] = total.get(key, 0) + value
+
+
+def _with_yield(counts: dict[str, int]) -> dict:
+    tokens = counts.get("tokens", 0)
+    return {**counts, "packing_yield": counts.get("usable_tokens", 0) / max(tokens, 1)}
+
+
+def _batched(texts: Iterable[str], batch_size: int) -> Iterable[list[str]]:
+    batch = []
+    for text in texts:
+        batch.append(text)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def token_census(
+    sources: dict[str, Callable[[], Iterable[str]]],
+    tokenizer_name: str,
+    ctx_len: int,
+    target_tokens: Optional[int] = None,
+    fractions: Optional[dict[str, float]] = None,
+    settings: Optional[dict] = None,
+    batch_size: int = 1_000,
+    batches_per_shard: int = 100,
+    num_workers: Optional[int] = None,
+) -> dict:
+    """
+    Counts the tokens of every source by tokenizing batches of samples across a process
+    pool. `fractions` are the token fractions the sources are mixed at (see
+    TokenRatioMixer), one source at fraction 1 by default. Each source is read until it
+    is exhausted, or until it has yielded its fraction of `target_tokens` usable tokens
+    (tokens left after truncation to ctx_len).
+
+    Returns a manifest with per-source and per-shard counts and the packing yield
+    (usable_tokens / tokens) at ctx_len. A shard is batch_size * batches_per_shard
+    consecutive samples of a source. `settings` should describe how the sources were
+    built (dataset names, min_chars, ...). It is stored in the manifest and checked by
+    steps_from_manifest against the settings of the run.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if fractions is None:
+        fractions = {name: 1.0 for name in sources}
+    if set(fractions) != set(sources):
+        raise ValueError("sources and fractions must have the same keys")
+    # Like TokenRatioMixer, sources with a zero fraction are never read
+    total_fraction = sum(fractions.values())
+    fractions = {
+        name: frac / total_fraction for name, frac in fractions.items() if frac > 0
+    }
+
+    manifest = {
+        "tokenizer": tokenizer_name,
+        "ctx_len": ctx_len,
+        "target_tokens": target_tokens,
+        "fractions": fractions,
+        # Round trip through JSON so it compares equal to a loaded manifest
+        "settings": json.loads(json.dumps(settings)),
+        "shard_size": batch_size * batches_per_shard,
+        "sources": {},
+    }
+    total = {}
+    start_time = time.time()
+
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_worker,
+        initargs=(tokenizer_name,),
+    ) as executor:
+        for name, fraction in fractions.items():
+            make_iter = sources[name]
+            source_total = {}
+            shards: dict[int, dict[str, int]] = {}
+            in_flight = {}
+            exhausted = True
+
+            def collect(done):
+                for future in done:
+                    shard_index = in_flight.pop(future)
+                    counts = future.result()
+                    _add_counts(source_total, counts)
+                    _add_counts(shards.setdefault(shard_index, {}), counts)
+
+            for batch_index, batch in enumerate(_batched(make_iter(), batch_size)):
+                if (
+                    target_tokens is not None
+                    and source_total.get("usable_tokens", 0) >= target_tokens * fraction
+                ):
+                    exhausted = False
+                    break
+
+                future = executor.submit(_count_batch, batch, ctx_len)
+                in_flight[future] = batch_index // batches_per_shard
+
+                # Bound the number of batches held in memory
+                if len(in_flight) >= 2 * num_workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                if batch_index % batches_per_shard == 0:
+                    print(
+                        f"{name}: {source_total.get('samples', 0):,} samples – "
+                        f"{source_total.get('tokens', 0):,} tokens"
+                    )
+
+            done, _ = wait(in_flight)
+            collect(done)
+
+            manifest["sources"][name] = {
+                **_with_yield(source_total),
+                "exhausted": exhausted,
+                "shards": [
+                    {"index": i, **_with_yield(shards[i])} for i in sorted(shards)
+                ],
+            }
+            _add_counts(total, source_total)
+
+    manifest["total"] = _with_yield(total)
+    manifest["seconds"] = time.time() - start_time
+    return manifest
+
+
+def save_manifest(manifest: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_manifest(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def available_tokens(manifest: dict) -> tuple[int, str]:
+    """
+    Usable tokens the mixed stream yields before its first source runs out, and that
+    source. TokenRatioMixer stops at the first exhausted source, so this is
+    min(usable_tokens / fraction) over the sources, not the total of all sources.
+    """
+    limits = {
+        name: manifest["sources"][name]["usable_tokens"] / fraction
+        for name, fraction in manifest["fractions"].items()
+    }
+    name = min(limits, key=limits.get)
+    return int(limits[name]), name
+
+
+def steps_from_manifest(
+    manifest_path: str,
+    num_tokens: int,
+    tokens_per_step: int,
+    ctx_len: int,
+    tokenizer_name: str,
+    settings: dict,
+    allow_fewer_steps: bool = False,
+) -> int:
+    """
+    Returns the number of training steps for num_tokens, checked against a token census
+    instead of re-counting the dataset. Raises ValueError if the manifest was computed
+    with a different tokenizer, ctx_len or dataset settings, and RuntimeError if the data
+    would run out, unless allow_fewer_steps is set, in which case steps are sized to the
+    data available.
+    """
+    manifest = load_manifest(manifest_path)
+
+    expected = {
+        "tokenizer": tokenizer_name,
+        "ctx_len": ctx_len,
+        "settings": json.loads(json.dumps(settings)),
+    }
+    mismatches = [
+        f"{key}: manifest has {manifest.get(key)!r}, training uses {value!r}"
+        for key, value in expected.items()
+        if manifest.get(key) != value
+    ]
+    if mismatches:
+        raise ValueError(
+            "Token manifest does not describe the training data:\n  "
+            + "\n  ".join(mismatches)
+        )
+
+    steps = num_tokens // tokens_per_step
+    available, limiting_source = available_tokens(manifest)
+    if available >= num_tokens:
+        return steps
+
+    if not manifest["sources"][limiting_source]["exhausted"]:
+        raise ValueError(
+            f"Census stopped at target_tokens={manifest['target_tokens']:,}, which is less "
+            f"than the {num_tokens:,} tokens needed. Re-run it with a larger target."
+        )
+
+    if not allow_fewer_steps:
+        raise RuntimeError(
+            f"Dataset exhausted after {available:,} usable tokens, when source "
+            f"{limiting_source!r} runs out; needed {num_tokens:,}."
+        )
+
+    available_steps = available // tokens_per_step
+    print(
+        f"WARNING: only {available:,} usable tokens available, "
+        f"training for {available_steps} steps instead of {steps}"
+    )
+    return available_steps
+
+
+# ------------------------------------------------------------
+# Example use
+# ------------------------------------------------------------
+if __name__ == "__main__":
+    # Census of the stream demo.py trains on, e.g.
+    # python token_census.py --model_name Qwen/Qwen2.5-Coder-32B-Instruct --mixed_dataset
+    # The manifest can be passed to demo.py with --token_manifest so the run fails fast
+    # instead of running out of data.
+    import argparse
+    from transformers import AutoTokenizer
+
+    import demo
+    import demo_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, required=True)
+    parser.add_argument("--mixed_dataset", action="store_true")
+    parser.add_argument("--target_tokens", type=int, default=500_000_000)
+    parser.add_argument("--output", type=str, default="token_manifest.json")
+    args = parser.parse_args()
+
+    tok = AutoTokenizer.from_pretrained(args.model_name)
+    settings = demo.get_dataset_settings(args.model_name, args.mixed_dataset)
+    # The mixer's sources are counted separately, as it stops when either runs out
+    sources, fractions = demo.get_dataset_sources(tok, settings)
+
+    manifest = token_census(
+        sources=sources,
+        tokenizer_name=args.model_name,
+        ctx_len=demo_config.LLM_CONFIG[args.model_name].context_length,
+        target_tokens=args.target_tokens,
+        fractions=fractions,
+        settings=settings,
+    )
+
+    save_manifest(manifest, args.output)
+    tokens, limiting_source = available_tokens(manifest)
+    print(json.dumps(manifest["total"], indent=2))
+    print(f"{tokens:,} usable tokens before {limiting_source!r} runs out")
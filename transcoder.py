@@ -0,0 +1,306 @@
+"""
+TopK transcoder: a sparse dictionary that encodes the input of a submodule (usually the
+MLP) and reconstructs its output. Trained on the paired (batch, 2, d) rows of
+CaptureBuffer(io="in_and_out"), with x[:, 0] the input and x[:, 1] the target.
+
+The trainer follows the interface of dictionary_learning's trainers (update, ae,
+config), so it runs under sae_training.train_saes and cpu_pool_training like any
+other config from demo_config.get_trainer_configs.
+"""
+
+import json
+import os
+from typing import Iterator, Optional, Union
+
+import torch as t
+import torch.nn as nn
+
+# A feature that has not fired for this many tokens counts as dead for the auxiliary loss
+DEAD_FEATURE_THRESHOLD = 10_000_000
+
+
+class TopKTranscoder(nn.Module):
+    def __init__(self, activation_dim: int, dict_size: int, k: int):
+        super().__init__()
+        self.activation_dim = activation_dim
+        self.dict_size = dict_size
+        self.register_buffer("k", t.tensor(k, dtype=t.int))
+
+        self.encoder = nn.Linear(activation_dim, dict_size)
+        self.encoder.bias.data.zero_()
+        self.decoder = nn.Linear(dict_size, activation_dim, bias=False)
+        self.decoder.weight.data = self.encoder.weight.data.clone().T
+        self.decoder.weight.data /= self.decoder.weight.data.norm(dim=0, keepdim=True)
+        # Bias in the output space, the input is not centered
+        self.b_dec = nn.Parameter(t.zeros(activation_dim))
+
+    def encode(self, x: t.Tensor, return_topk: bool = False):
+        post_relu = nn.functional.relu(self.encoder(x))
+        top = post_relu.topk(int(self.k), sorted=False, dim=-1)
+        features = t.zeros_like(post_relu).scatter_(-1, top.indices, top.values)
+        if return_topk:
+            return features, top.values, top.indices, post_relu
+        return features
+
+    def decode(self, f: t.Tensor) -> t.Tensor:
+        return self.decoder(f) + self.b_dec
+
+    def forward(self, x: t.Tensor, output_features: bool = False):
+        f = self.encode(x)
+        y_hat = self.decode(f)
+        if output_features:
+            return y_hat, f
+        return y_hat
+
+    @t.no_grad()
+    def scale_biases(self, scale: Union[float, list[float]]) -> None:
+        """
+        Converts the transcoder between normalized and raw activations. `scale` is
+        either one factor for both sides or [input_factor, output_factor] (see
+        sae_training.get_norm_factor). With different factors the decoder weights are
+        rescaled as well, so features keep the input's scale.
+        """
+        if isinstance(scale, (list, tuple)):
+            input_scale, output_scale = scale
+        else:
+            input_scale = output_scale = scale
+        self.encoder.bias.mul_(input_scale)
+        self.decoder.weight.mul_(output_scale / input_scale)
+        self.b_dec.mul_(output_scale)
+
+    @classmethod
+    def from_pretrained(
+        cls, path: str, k: Optional[int] = None, device: Optional[str] = None
+    ) -> "TopKTranscoder":
+        state_dict = t.load(path, map_location="cpu")
+        dict_size, activation_dim = state_dict["encoder.weight"].shape
+        if k is None:
+            k = state_dict["k"].item()
+        transcoder = cls(activation_dim, dict_size, k)
+        transcoder.load_state_dict(state_dict)
+        if device is not None:
+            transcoder.to(device)
+        return transcoder
+
+
+def load_transcoder(ae_path: str, device: str) -> tuple[TopKTranscoder, dict]:
+    """Same as utils.load_dictionary, for a trainer_i directory of a transcoder."""
+    with open(os.path.join(ae_path, "config.json"), "r") as f:
+        config = json.load(f)
+    transcoder = TopKTranscoder.from_pretrained(
+        os.path.join(ae_path, "ae.pt"), k=config["trainer"]["k"], device=device
+    )
+    return transcoder, config
+
+
+class TranscoderTopKTrainer:
+    """
+    TopK trainer with the loss taken against the submodule output. Uses the same
+    learning rate scaling, auxiliary dead-feature loss and unit-norm decoder
+    constraint as dictionary_learning's TopKTrainer.
+    """
+
+    def __init__(
+        self,
+        steps: int,
+        activation_dim: int,
+        dict_size: int,
+        k: int,
+        layer: int,
+        lm_name: str,
+        dict_class=TopKTranscoder,
+        lr: Optional[float] = None,
+        auxk_alpha: float = 1 / 32,
+        warmup_steps: int = 1000,
+        decay_start: Optional[int] = None,
+        seed: Optional[int] = None,
+        device: Optional[str] = None,
+        wandb_name: str = "TranscoderTopKTrainer",
+        submodule_name: Optional[str] = None,
+    ):
+        self.steps = steps
+        self.layer = layer
+        self.lm_name = lm_name
+        self.submodule_name = submodule_name
+        self.wandb_name = wandb_name
+        self.k = k
+        self.seed = seed
+        self.warmup_steps = warmup_steps
+        self.decay_start = decay_start
+        self.auxk_alpha = auxk_alpha
+
+        if seed is not None:
+            t.manual_seed(seed)
+            t.cuda.manual_seed_all(seed)
+
+        self.ae = dict_class(activation_dim, dict_size, k)
+        if device is None:
+            device = "cuda" if t.cuda.is_available() else "cpu"
+        self.device = device
+        self.ae.to(device)
+
+        # Scaling law from the TopK paper, as in TopKTrainer
+        self.lr = lr if lr is not None else 2e-4 / (dict_size / 2**14) ** 0.5
+        self.top_k_aux = activation_dim // 2
+        self.num_tokens_since_fired = t.zeros(dict_size, dtype=t.long, device=device)
+
+        self.optimizer = t.optim.Adam(self.ae.parameters(), lr=self.lr, betas=(0.9, 0.999))
+        self.scheduler = t.optim.lr_scheduler.LambdaLR(self.optimizer, lr_lambda=self._lr_factor)
+
+        self.logging_parameters = ["effective_l0", "dead_features"]
+        self.effective_l0 = -1
+        self.dead_features = -1
+
+    def _lr_factor(self, step: int) -> float:
+        if step < self.warmup_steps:
+            return (step + 1) / self.warmup_steps
+        if self.decay_start is not None and step >= self.decay_start:
+            return max(self.steps - step, 0) / max(self.steps - self.decay_start, 1)
+        return 1.0
+
+    def get_auxiliary_loss(self, residual: t.Tensor, post_relu: t.Tensor) -> t.Tensor:
+        dead_features = self.num_tokens_since_fired >= DEAD_FEATURE_THRESHOLD
+        self.dead_features = int(dead_features.sum())
+        if self.dead_features == 0:
+            return t.tensor(0.0, dtype=residual.dtype, device=residual.device)
+
+        k_aux = min(self.top_k_aux, self.dead_features)
+        auxk_latents = t.where(dead_features[None], post_relu, -t.inf)
+        top = auxk_latents.topk(k_aux, sorted=False)
+        auxk_acts = t.zeros_like(post_relu).scatter_(-1, top.indices, top.values)
+
+        residual_hat = self.ae.decoder(auxk_acts)
+        l2_loss_aux = (residual.float() - residual_hat.float()).pow(2).sum(dim=-1).mean()
+        residual_mu = residual.mean(dim=0)[None]
+        loss_denom = (residual.float() - residual_mu.float()).pow(2).sum(dim=-1).mean()
+        return (l2_loss_aux / loss_denom).nan_to_num(0.0)
+
+    def loss(self, x: t.Tensor, step: Optional[int] = None, logging: bool = False):
+        x_in, y = x[:, 0], x[:, 1]
+        f, top_acts, top_indices, post_relu = self.ae.encode(x_in, return_topk=True)
+        y_hat = self.ae.decode(f)
+        residual = y - y_hat
+
+        self.effective_l0 = self.k
+        fired = t.zeros(self.ae.dict_size, dtype=t.bool, device=x.device)
+        fired[top_indices.flatten()[top_acts.flatten() > 0]] = True
+        self.num_tokens_since_fired += x.size(0)
+        self.num_tokens_since_fired[fired] = 0
+
+        l2_loss = residual.pow(2).sum(dim=-1).mean()
+        auxk_loss = self.get_auxiliary_loss(residual.detach(), post_relu)
+        loss = l2_loss + self.auxk_alpha * auxk_loss
+
+        if not logging:
+            return loss
+        return {
+            "x": x_in,
+            "x_hat": y_hat,
+            "f": f,
+            "losses": {
+                "l2_loss": l2_loss.item(),
+                "auxk_loss": auxk_loss.item(),
+                "loss": loss.item(),
+            },
+        }
+
+    @t.no_grad()
+    def _remove_parallel_decoder_grad(self) -> None:
+        weight = self.ae.decoder.weight
+        if weight.grad is None:
+            return
+        normed = weight / weight.norm(dim=0, keepdim=True)
+        parallel = (weight.grad * normed).sum(dim=0, keepdim=True)
+        weight.grad -= parallel * normed
+
+    def update(self, step: int, x: t.Tensor) -> float:
+        x = x.to(self.device)
+        if step == 0:
+            # Start the output bias at the mean target, as TopKTrainer does with b_dec
+            self.ae.b_dec.data = x[:, 1].mean(dim=0).to(self.ae.b_dec.dtype)
+
+        loss = self.loss(x, step=step)
+        loss.backward()
+
+        self._remove_parallel_decoder_grad()
+        t.nn.utils.clip_grad_norm_(self.ae.parameters(), 1.0)
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+        self.scheduler.step()
+
+        with t.no_grad():
+            weight = self.ae.decoder.weight
+            weight /= weight.norm(dim=0, keepdim=True)
+
+        return loss.item()
+
+    def get_logging_parameters(self) -> dict:
+        return {name: getattr(self, name) for name in self.logging_parameters}
+
+    @property
+    def config(self) -> dict:
+        return {
+            "trainer_class": "TranscoderTopKTrainer",
+            "dict_class": "TopKTranscoder",
+            "lr": self.lr,
+            "steps": self.steps,
+            "auxk_alpha": self.auxk_alpha,
+            "warmup_steps": self.warmup_steps,
+            "decay_start": self.decay_start,
+            "seed": self.seed,
+            "activation_dim": self.ae.activation_dim,
+            "dict_size": self.ae.dict_size,
+            "k": self.k,
+            "device": self.device,
+            "layer": self.layer,
+            "lm_name": self.lm_name,
+            "wandb_name": self.wandb_name,
+            "submodule_name": self.submodule_name,
+        }
+
+
+@t.no_grad()
+def evaluate_transcoder(
+    dictionary: TopKTranscoder,
+    activations: Iterator[t.Tensor],
+    context_length: int,
+    batch_size: int,
+    io: str = "in_and_out",
+    device: str = "cpu",
+    n_batches: int = 1,
+) -> dict:
+    """
+    Reconstruction metrics of a transcoder on paired batches, with the same signature
+    and metric names as dictionary_learning's evaluate. The target is x[:, 1]. Loss
+    recovered is not computed, since it needs the output patched into a full forward.
+    """
+    if io != "in_and_out":
+        raise ValueError("Transcoders are evaluated on io='in_and_out' batches")
+
+    sums = {}
+    alive = t.zeros(dictionary.dict_size, dtype=t.bool, device=device)
+
+    for _ in range(n_batches):
+        x = next(activations).to(device)
+        x_in, y = x[:, 0].to(dictionary.b_dec.dtype), x[:, 1].float()
+        y_hat, f = dictionary(x_in, output_features=True)
+        y_hat = y_hat.float()
+        residual = y - y_hat
+
+        total_variance = (y - y.mean(dim=0)).pow(2).sum()
+        metrics = {
+            "l2_loss": residual.norm(dim=-1).mean().item(),
+            "l1_loss": f.float().norm(p=1, dim=-1).mean().item(),
+            "l0": (f != 0).float().sum(dim=-1).mean().item(),
+            "mse": residual.pow(2).mean().item(),
+            "frac_variance_explained": (1 - residual.pow(2).sum() / total_variance).item(),
+            "cossim": t.nn.functional.cosine_similarity(y_hat, y, dim=-1).mean().item(),
+            "l2_ratio": (y_hat.norm(dim=-1) / y.norm(dim=-1)).mean().item(),
+        }
+        for key, value in metrics.items():
+            sums[key] = sums.get(key, 0.0) + value
+        alive |= (f != 0).any(dim=0)
+
+    results = {key: value / n_batches for key, value in sums.items()}
+    results["frac_alive"] = alive.float().mean().item()
+    return results